@@ -0,0 +1,169 @@
+import calendar, functools, pathlib
+
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+from . import concurrency
+from .extraction import FileMetadata
+
+MISSING = -1
+
+
+def number_tag(tag: str, scale: int = 1) -> Callable[[dict[str, Any]], int | None]:
+    def encode(tags: dict[str, Any]) -> int | None:
+        value = tags.get(tag)
+        if isinstance(value, (int, float)) and value > 0:
+            return round(value * scale)
+        return None
+    return encode
+
+def text_tag(tag: str) -> Callable[[dict[str, Any]], str | None]:
+    def encode(tags: dict[str, Any]) -> str | None:
+        value = tags.get(tag)
+        return (value.strip() or None) if isinstance(value, str) else None
+    return encode
+
+def capture_time_field(start: int, end: int) -> Callable[[dict[str, Any]], int | None]:
+    """Slice a field out of the "YYYY:MM:DD HH:MM:SS" capture time string, without parsing the whole thing."""
+    def encode(tags: dict[str, Any]) -> int | None:
+        value = tags.get("datetime_original")
+        if isinstance(value, str) and value[start:end].isdigit():
+            return int(value[start:end])
+        return None
+    return encode
+
+def camera_name(tags: dict[str, Any]) -> str | None:
+    make = text_tag("make")(tags) or ""
+    model = text_tag("model")(tags) or ""
+    if not model:
+        return make or None
+    elif make and not model.lower().startswith(make.split()[0].lower()):
+        return f"{make} {model}"
+    else:
+        return model
+
+
+@dataclass(frozen=True)
+class Dimension:
+    name: str
+    title: str
+    tags: tuple[str, ...]
+    encode: Callable[[dict[str, Any]], int | str | None]
+    categorical: bool = False
+    format: Callable[[int], str] = str
+
+
+DIMENSIONS = {d.name: d for d in [
+    Dimension("focal_length", "Focal lengths", ("focal_length_in_35mm_film",), number_tag("focal_length_in_35mm_film"), format=lambda v: f"{v}mm"),
+    Dimension("aperture", "Apertures", ("f_number",), number_tag("f_number", scale=10), format=lambda v: f"f/{v / 10:g}"),
+    Dimension("iso", "ISO sensitivities", ("photographic_sensitivity",), number_tag("photographic_sensitivity"), format=lambda v: f"ISO {v}"),
+    Dimension("camera", "Cameras", ("make", "model"), camera_name, categorical=True),
+    Dimension("lens", "Lenses", ("lens_model",), text_tag("lens_model"), categorical=True),
+    Dimension("hour", "Capture hours", ("datetime_original",), capture_time_field(11, 13), format=lambda v: f"{v:02}h"),
+    Dimension("month", "Capture months", ("datetime_original",), capture_time_field(5, 7), format=lambda v: calendar.month_abbr[v] if 1 <= v <= 12 else str(v)),
+]}
+
+GROUPINGS: dict[str, Callable[[pathlib.Path, dict[str, Any]], str]] = {
+    "none": lambda path, tags: "",
+    "folder": lambda path, tags: str(path.parent),
+    "year": lambda path, tags: str(capture_time_field(0, 4)(tags) or "unknown"),
+}
+
+
+class Categories:
+    """Dictionary encoding of text values to small integer codes."""
+
+    def __init__(self):
+        self.codes: dict[str, int] = dict()
+        self.values: list[str] = []
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+@dataclass
+class PartialStats:
+    """Histograms of one shard of files. Partial results of any number of shards can be merged."""
+    files: int
+    histograms: dict[str, Counter]
+
+    def merge(self, other: "PartialStats") -> "PartialStats":
+        names = self.histograms.keys() | other.histograms.keys()
+        return PartialStats(self.files + other.files,
+                            {name: self.histograms.get(name, Counter()) + other.histograms.get(name, Counter()) for name in names})
+
+
+class MetadataColumns:
+    """
+    Column store for the metadata of one shard of files: one integer array per dimension,
+    with text values dictionary-encoded, so a million files cost a few MB rather than a million dicts.
+    """
+
+    def __init__(self, dimensions: Iterable[str]):
+        self.dimensions = tuple(dimensions)
+        self.files = 0
+        self.columns = {name: array("q") for name in self.dimensions}
+        self.categories = {name: Categories() for name in self.dimensions if DIMENSIONS[name].categorical}
+
+    def append(self, tags: dict[str, Any] | None):
+        self.files += 1
+        for name in self.dimensions:
+            value = DIMENSIONS[name].encode(tags) if tags else None
+            if value is None:
+                value = MISSING
+            elif name in self.categories:
+                value = self.categories[name].encode(value)
+            self.columns[name].append(value)
+
+    def partial(self) -> PartialStats:
+        histograms = dict()
+        for name in self.dimensions:
+            # Counting a typed array happens in C, one pass per column
+            counts = Counter(self.columns[name])
+            counts.pop(MISSING, None)
+            if name in self.categories:
+                values = self.categories[name].values
+                counts = Counter({values[code]: n for code, n in counts.items()})
+            histograms[name] = counts
+        return PartialStats(self.files, histograms)
+
+
+def collect_columns(results: Iterable[FileMetadata], dimensions: Iterable[str], group_by: str = "none") -> dict[str, MetadataColumns]:
+    dimensions = tuple(dimensions)
+    group_key = GROUPINGS[group_by]
+    shards: dict[str, MetadataColumns] = dict()
+    for result in results:
+        tags = result.tags or {}
+        group = group_key(result.path, tags)
+        columns = shards.get(group)
+        if columns is None:
+            columns = shards[group] = MetadataColumns(dimensions)
+        columns.append(tags)
+    return shards
+
+def summarize(shards: dict[str, MetadataColumns], jobs: int = 1, processes: bool = False) -> dict[str, PartialStats]:
+    """Compute the histograms of all shards, in parallel on worker threads or processes."""
+    with concurrency.make_executor(jobs, processes) as executor:
+        return dict(zip(shards.keys(), executor.map(MetadataColumns.partial, shards.values())))
+
+def merge(partials: Iterable[PartialStats]) -> PartialStats:
+    return functools.reduce(PartialStats.merge, partials, PartialStats(0, dict()))
+
+def required_tags(dimensions: Iterable[str], group_by: str = "none") -> list[str]:
+    tags = [tag for name in dimensions for tag in DIMENSIONS[name].tags]
+    if group_by == "year":
+        tags.append("datetime_original")
+    return list(dict.fromkeys(tags))
+
+def sorted_keys(dimension: Dimension, counts: Counter) -> list:
+    """Numeric values in ascending order, text values by frequency."""
+    if dimension.categorical:
+        return [key for key, _ in counts.most_common()]
+    else:
+        return sorted(counts)
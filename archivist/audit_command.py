@@ -0,0 +1,80 @@
+import pathlib
+
+from dataclasses import dataclass
+
+from . import concurrency, integrity, reporting, utils
+from .constants import DEFAULT_AUDIT_JOBS
+from .content_index import ContentIndex, IndexEntry
+from .progress import Progress
+
+
+@dataclass(slots=True)
+class AuditResult:
+    entry: IndexEntry
+    full_hash: str | None = None
+    error: OSError | None = None
+
+    @property
+    def status(self) -> str:
+        if self.error is not None:
+            return "error"
+        elif self.entry.full_hash is None:
+            return "recorded"
+        elif self.full_hash == self.entry.full_hash:
+            return "ok"
+        else:
+            return "corrupt"
+
+
+def check_entry(entry: IndexEntry, limiter: integrity.RateLimiter) -> AuditResult:
+    try:
+        return AuditResult(entry, integrity.hash_file(entry.path, limiter))
+    except OSError as err:
+        return AuditResult(entry, error=err)
+
+def audit(archive: pathlib.Path, jobs: int = DEFAULT_AUDIT_JOBS, max_rate: float | None = None) -> int:
+    """
+    Re-read every file in the archive from disk and compare it with its recorded hash, several files at a time,
+    reading at most max_rate MB/s in total. Files without a recorded hash get one, to be checked on the next audit.
+    Files whose size or modification time changed were edited rather than corrupted, and get a new hash, too.
+    Returns the number of corrupt files.
+    """
+    if not archive.is_dir():
+        reporting.warn(utils.error_str("Archive folder doesn't exist. Exiting."))
+        return 0
+
+    limiter = integrity.RateLimiter(max_rate * 1e6 if max_rate else None)
+    counts = {"ok": 0, "corrupt": 0, "recorded": 0, "error": 0}
+    with ContentIndex(archive) as index:
+        reporting.echo("Updating archive content index... ", nl=False)
+        with reporting.stage("refresh"):
+            reporting.echo(f"{index.refresh()} new or changed files.")
+        entries = index.entries()
+        reporting.echo(f"Auditing {len(entries)} files...")
+
+        sizes = {entry.path: entry.size for entry in entries}
+        progress = Progress("Audited", lambda: f"{counts["corrupt"]} corrupt", size=lambda file: sizes.pop(file, 0))
+        with concurrency.make_executor(jobs) as executor, reporting.stage("audit"):
+            for result in concurrency.ordered_map(executor, lambda entry: check_entry(entry, limiter), entries, window=jobs * 4):
+                status = result.status
+                counts[status] += 1
+                path = result.entry.path
+                if status == "corrupt":
+                    reporting.warn(utils.error_str(f"{path} is corrupt: its contents changed without its size or modification time changing."))
+                    reporting.record("audit", status, path=path, expected=result.entry.full_hash, actual=result.full_hash)
+                elif status == "error":
+                    reporting.warn(utils.error_str(f"Unable to read '{path}': {result.error}"))
+                    reporting.record("audit", status, path=path, error=str(result.error))
+                else:
+                    if status == "recorded":
+                        index.set_full_hash(path, result.full_hash)
+                    reporting.record("audit", status, path=path, bytes=result.entry.size)
+                progress.advance(path)
+        progress.finish()
+
+    reporting.echo(f"{counts["ok"]} files intact, {counts["recorded"]} checksums recorded for the first time.")
+    if counts["error"]:
+        reporting.warn(utils.error_str(f"{counts["error"]} files could not be read."))
+    if counts["corrupt"]:
+        reporting.warn(utils.error_str(f"{counts["corrupt"]} files are corrupt - restore them from a backup."))
+    return counts["corrupt"]
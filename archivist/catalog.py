@@ -0,0 +1,205 @@
+import contextlib, os, pathlib, sqlite3
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator
+
+from . import concurrency, extraction, metadata, utils
+from .metadata_cache import MetadataCache
+
+CATALOG_FILE_NAME = ".archivist-catalog.sqlite3"
+
+
+def exif_value(value: Any) -> int | float | str | None:
+    return value if value is None or isinstance(value, (int, float, str)) else str(value)
+
+def exif_date(date: str) -> str:
+    """Turn a YYYY[-MM[-DD]] date into the format of the datetime_original tag."""
+    return date.replace("-", ":")
+
+
+@dataclass
+class Filters:
+    folders: list[pathlib.Path] = field(default_factory=list)
+    suffixes: set[str] = field(default_factory=set)
+    start: str | None = None
+    end: str | None = None
+    camera: str | None = None
+    lens: str | None = None
+    focal_lengths: tuple[int, int] | None = None
+
+    def where(self) -> tuple[str, list]:
+        clauses = []
+        params = []
+        if self.folders:
+            clauses.append("(" + " OR ".join("(path >= ? AND path < ?)" for _ in self.folders) + ")")
+            params.extend(bound for folder in self.folders for bound in utils.prefix_range(folder))
+        if self.suffixes:
+            clauses.append(f"normalize_suffix(suffix) IN ({", ".join("?" * len(self.suffixes))})")
+            params.extend(utils.normalize_suffix_str(s if s.startswith(".") else "." + s) for s in self.suffixes)
+        if self.start:
+            clauses.append("datetime_original >= ?")
+            params.append(exif_date(self.start))
+        if self.end:
+            # Inclusive, for whatever the end date is precise to
+            clauses.append("substr(datetime_original, 1, ?) <= ?")
+            params.extend([len(self.end), exif_date(self.end)])
+        if self.camera:
+            clauses.append("(coalesce(make, '') || ' ' || coalesce(model, '')) LIKE ?")
+            params.append(f"%{self.camera}%")
+        if self.lens:
+            clauses.append("lens_model LIKE ?")
+            params.append(f"%{self.lens}%")
+        if self.focal_lengths:
+            clauses.append("focal_length_in_35mm_film BETWEEN ? AND ?")
+            params.extend(self.focal_lengths)
+        return " AND ".join(clauses) or "1", params
+
+
+class Catalog:
+    """
+    Index of every image file in an archive, with the EXIF tags archivist uses, kept in the archive.
+
+    It's brought up to date by comparing folder modification times with the ones recorded on the last refresh:
+    only folders with files added, removed or renamed are listed again, and only new or changed files are read.
+    """
+
+    def __init__(self, archive: pathlib.Path):
+        self.archive = archive
+        self._connection = sqlite3.connect(archive / CATALOG_FILE_NAME)
+        self._connection.create_function("normalize_suffix", 1, utils.normalize_suffix_str, deterministic=True)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        tag_columns = ", ".join(metadata.METADATA_TAGS)
+        self._connection.execute(f"CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, folder TEXT, suffix TEXT, size INTEGER, mtime_ns INTEGER, {tag_columns})")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS files_folder ON files (folder)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS files_datetime ON files (datetime_original)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def refresh(self, full: bool = False, jobs: int = concurrency.DEFAULT_JOBS, cache: MetadataCache | None = None) -> tuple[int, int]:
+        """Reconcile the catalog with the files on disk. Returns the number of new or changed files, and of removed ones."""
+        known_folders = {path: (parent, mtime_ns) for path, parent, mtime_ns in self._connection.execute("SELECT path, parent, mtime_ns FROM folders")}
+        changed: dict[pathlib.Path, os.stat_result] = dict()
+        removed = []
+        folder_rows = []
+        visited = set()
+        for folder, parent, mtime_ns, files in utils.scan_changed_folders(self.archive, known_folders, full):
+            visited.add(folder)
+            if files is None:
+                continue
+            known_files = {path: (size, mtime_ns) for path, size, mtime_ns in
+                           self._connection.execute("SELECT path, size, mtime_ns FROM files WHERE folder = ?", (folder,))}
+            for entry in files:
+                if utils.has_accepted_suffix(entry.name, utils.IMAGE_EXTS):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if known_files.pop(entry.path, None) != (stat.st_size, stat.st_mtime_ns):
+                        changed[pathlib.Path(entry.path)] = stat
+            removed.extend(known_files)
+            folder_rows.append((folder, parent, mtime_ns))
+
+        gone_folders = [(path,) for path in known_folders.keys() - visited]
+        self._connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in removed))
+        self._connection.executemany("DELETE FROM files WHERE folder = ?", gone_folders)
+        self._connection.executemany("DELETE FROM folders WHERE path = ?", gone_folders)
+        self._store(changed, jobs, cache)
+        # Recorded last, so an interrupted refresh lists these folders again next time
+        self._connection.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", folder_rows)
+        self._connection.commit()
+        return len(changed), len(removed)
+
+    def add_files(self, files: Iterable[pathlib.Path], jobs: int = concurrency.DEFAULT_JOBS, cache: MetadataCache | None = None):
+        """Catalog files just added to the archive, or changed in it."""
+        file_stats = dict()
+        for file in files:
+            try:
+                file_stats[file] = file.stat()
+            except OSError:
+                continue
+        self._store(file_stats, jobs, cache)
+        self._connection.commit()
+
+    def rename(self, renames: Iterable[tuple[pathlib.Path, pathlib.Path]]):
+        self._connection.executemany("UPDATE files SET path = ?, folder = ?, suffix = ? WHERE path = ?",
+                                     ((str(target.absolute()), str(target.parent.absolute()), target.suffix, str(source.absolute())) for source, target in renames))
+        self._connection.commit()
+
+    def remove(self, files: Iterable[pathlib.Path]):
+        self._connection.executemany("DELETE FROM files WHERE path = ?", ((str(file.absolute()),) for file in files))
+        self._connection.commit()
+
+    def files(self, filters: Filters) -> Iterator[extraction.FileMetadata]:
+        where, params = filters.where()
+        tag_columns = ", ".join(metadata.METADATA_TAGS)
+        for path, *values in self._connection.execute(f"SELECT path, {tag_columns} FROM files WHERE {where} ORDER BY path", params):
+            tags = dict(zip(metadata.METADATA_TAGS, values))
+            yield extraction.FileMetadata(pathlib.Path(path), tags if any(v is not None for v in values) else None)
+
+    def suffix_counts(self, filters: Filters) -> list[tuple[str, int]]:
+        where, params = filters.where()
+        return self._connection.execute(f"SELECT suffix, COUNT(*) FROM files WHERE {where} GROUP BY suffix", params).fetchall()
+
+    def _store(self, file_stats: dict[pathlib.Path, os.stat_result], jobs: int, cache: MetadataCache | None = None):
+        rows = []
+        for result in extraction.extract_metadata(file_stats, metadata.METADATA_TAGS, cache, jobs, file_stats=file_stats):
+            stat = file_stats[result.path]
+            tags = result.tags or {}
+            rows.append((str(result.path.absolute()), str(result.path.parent.absolute()), result.path.suffix, stat.st_size, stat.st_mtime_ns,
+                         *(exif_value(tags.get(tag)) for tag in metadata.METADATA_TAGS)))
+        placeholders = ", ".join("?" * (5 + len(metadata.METADATA_TAGS)))
+        self._connection.executemany(f"INSERT OR REPLACE INTO files VALUES ({placeholders})", rows)
+
+
+def find_catalog_root(path: pathlib.Path) -> pathlib.Path | None:
+    """The archive whose catalog covers the given path, if there is one."""
+    path = path.absolute()
+    for folder in [path, *path.parents]:
+        if (folder / CATALOG_FILE_NAME).is_file():
+            return folder
+    return None
+
+def find_common_catalog_root(paths: Iterable[pathlib.Path]) -> pathlib.Path | None:
+    """The archive whose catalog covers all the given paths, if there is one."""
+    roots = {find_catalog_root(path) for path in paths}
+    return roots.pop() if len(roots) == 1 else None
+
+def open_catalog(archive: pathlib.Path, create: bool = False) -> contextlib.AbstractContextManager[Catalog | None]:
+    if not archive.is_dir() or not (create or (archive / CATALOG_FILE_NAME).is_file()):
+        return contextlib.nullcontext(None)
+    else:
+        return Catalog(archive)
+
+@contextlib.contextmanager
+def covering_catalogs() -> Iterator[Callable[[pathlib.Path], Catalog | None]]:
+    """Yield a lookup of the catalog covering a file, opening each catalog once - for commands working on arbitrary folders."""
+    roots: dict[pathlib.Path, pathlib.Path | None] = dict()
+    catalogs: dict[pathlib.Path, Catalog] = dict()
+
+    def lookup(file: pathlib.Path) -> Catalog | None:
+        folder = file.parent
+        if folder not in roots:
+            roots[folder] = find_catalog_root(folder)
+        root = roots[folder]
+        if root is None:
+            return None
+        if root not in catalogs:
+            catalogs[root] = Catalog(root)
+        return catalogs[root]
+
+    try:
+        yield lookup
+    finally:
+        for catalog in catalogs.values():
+            catalog.close()
@@ -1,14 +1,15 @@
-import pathlib
-import click
+import os, pathlib
 
-from dataclasses import dataclass
+from collections import defaultdict
+from dataclasses import dataclass, field
 from typing import Iterable
 
-from . import utils
+from . import concurrency, instrumentation, reporting, utils
+from .catalog import covering_catalogs
 from .count_command import collect_file_suffix_stats
 
 
-@dataclass
+@dataclass(slots=True)
 class FileMatch:
     raw_file: pathlib.Path | None
     processed_file: pathlib.Path | None
@@ -30,6 +31,38 @@ class FileMatch:
         return self.has_raw and not self.has_processed
 
 
+@dataclass(slots=True)
+class FolderPair:
+    """A folder with a "raw" subfolder, with the names of the files in both - paths are only made for files acted on."""
+    base_folder: pathlib.Path
+    raw_folder: pathlib.Path
+    processed_names: list[str] = field(default_factory=list)
+    raw_names: list[str] = field(default_factory=list)
+
+    @property
+    def processed_files(self) -> list[pathlib.Path]:
+        return [self.base_folder / name for name in self.processed_names]
+
+    @property
+    def raw_files(self) -> list[pathlib.Path]:
+        return [self.raw_folder / name for name in self.raw_names]
+
+
+@dataclass(slots=True)
+class FolderCleanup:
+    pair: FolderPair
+    matched: int
+    removed: list[pathlib.Path]
+    failures: dict[pathlib.Path, OSError]
+
+
+@dataclass(slots=True)
+class MatchPartitions:
+    both_present: list[FileMatch] = field(default_factory=list)
+    processed_present: list[FileMatch] = field(default_factory=list)
+    raw_present: list[FileMatch] = field(default_factory=list)
+
+
 def find_default_raw_folder(base_folder: pathlib.Path) -> pathlib.Path | None:
     raw_folder_candidate = base_folder / "raw"
     if raw_folder_candidate.is_dir():
@@ -37,88 +70,211 @@ def find_default_raw_folder(base_folder: pathlib.Path) -> pathlib.Path | None:
     else:
         return None
 
-def find_file_matches(processed_files: Iterable[pathlib.Path], raw_files: Iterable[pathlib.Path], raw_folder: pathlib.Path) -> list[FileMatch]:
-    normalized_raw_to_original_raw = {utils.normalize_suffix(r): r for r in raw_files}
+def stem_index(files: Iterable[pathlib.Path]) -> dict[str, list[pathlib.Path]]:
+    index = defaultdict(list)
+    for file in files:
+        index[os.path.splitext(file.name)[0]].append(file)
+    return index
+
+@instrumentation.instrumented("find_file_matches")
+def find_file_matches(processed_files: Iterable[pathlib.Path], raw_files: Iterable[pathlib.Path]) -> list[FileMatch]:
+    """Pair processed and RAW files by file name stem, with a single lookup per processed file."""
+    raw_by_stem = stem_index(raw_files)
     matches = []
-    
+
     for processed_file in processed_files:
-        for raw_suffix in utils.RAW_EXTS:
-            raw_file_candidate = raw_folder / processed_file.with_suffix(raw_suffix).name
-            raw_match = normalized_raw_to_original_raw.pop(raw_file_candidate, None)
-            if raw_match:
-                matches.append(FileMatch(raw_match, processed_file))
-                break
+        raw_candidates = raw_by_stem.get(os.path.splitext(processed_file.name)[0])
+        if raw_candidates:
+            matches.append(FileMatch(raw_candidates.pop(0), processed_file))
         else:
             # No RAW match found for processed file - add a non-matched entry
             matches.append(FileMatch(None, processed_file))
-    
-    # Left now are all unmatched RAW files as values in the above dict
-    matches.extend((FileMatch(r, None) for r in normalized_raw_to_original_raw.values()))
+
+    # Left now are all unmatched RAW files
+    matches.extend(FileMatch(r, None) for raw_candidates in raw_by_stem.values() for r in raw_candidates)
 
     return matches
 
-def print_matches(file_matches: Iterable[FileMatch]):
-    both_present = [f for f in file_matches if f.is_matched]
-    processed_present = [f for f in file_matches if f.has_processed and not f.has_raw]
-    raw_present = [f for f in file_matches if f.has_raw and not f.has_processed]
+def find_folder_pairs(root: pathlib.Path, jobs: int = 1) -> list[FolderPair]:
+    """
+    Walk a whole archive once, collecting the processed files of every folder with a "raw" subfolder,
+    along with the RAW files in that subfolder.
+    """
+    processed_by_folder: dict[str, list[str]] = defaultdict(list)
+    raw_by_folder: dict[str, list[str]] = defaultdict(list)
+    for folder, name, _ in utils.walk_image_entries([root], recurse=True, jobs=jobs):
+        if not utils.has_accepted_suffix(name, utils.RAW_EXTS):
+            processed_by_folder[folder].append(name)
+        elif os.path.basename(folder) == "raw":
+            raw_by_folder[folder].append(name)
+    pairs = []
+    for raw_folder, raw_names in raw_by_folder.items():
+        base_folder = os.path.dirname(raw_folder)
+        pairs.append(FolderPair(pathlib.Path(base_folder), pathlib.Path(raw_folder), processed_by_folder.get(base_folder, []), raw_names))
+    return pairs
+
+def remove_files(folder: pathlib.Path, files: Iterable[pathlib.Path]) -> dict[pathlib.Path, OSError]:
+    """Unlink files of one folder relative to a single handle on it. Returns the files that couldn't be removed."""
+    files = list(files)
+    failures = dict()
+    dir_fd = None
+    try:
+        if os.unlink in os.supports_dir_fd:
+            dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+        for file in files:
+            try:
+                os.unlink(file.name if dir_fd is not None else file, dir_fd=dir_fd)
+            except OSError as err:
+                failures[file] = err
+    except OSError as err:
+        failures = {file: err for file in files}
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    return failures
+
+def partition_matches(file_matches: Iterable[FileMatch]) -> MatchPartitions:
+    partitions = MatchPartitions()
+    for match in file_matches:
+        if match.is_matched:
+            partitions.both_present.append(match)
+        elif match.has_processed:
+            partitions.processed_present.append(match)
+        else:
+            partitions.raw_present.append(match)
+    return partitions
 
-    if both_present:
-        click.echo(f"{utils.emphasis_str("Full Matches")} (both files present):")
-        for match in both_present:
-            click.echo(f"  {match.processed_file} -> {match.raw_file}")
+def print_matches(partitions: MatchPartitions):
+    if partitions.both_present:
+        reporting.echo(f"{utils.emphasis_str("Full Matches")} (both files present):")
+        for match in partitions.both_present:
+            reporting.echo(f"  {match.processed_file} -> {match.raw_file}")
     
-    if processed_present:
-        click.echo(f"{utils.emphasis_str("Partial Matches")} (only {utils.emphasis_str("processed")} file present):")
-        for match in processed_present:
-            click.echo(f"  {match.processed_file} -> X")
+    if partitions.processed_present:
+        reporting.echo(f"{utils.emphasis_str("Partial Matches")} (only {utils.emphasis_str("processed")} file present):")
+        for match in partitions.processed_present:
+            reporting.echo(f"  {match.processed_file} -> X")
 
-    if raw_present:
-        click.echo(f"{utils.emphasis_str("Partial Matches")} (only {utils.emphasis_str("RAW")} file present):")
-        for match in raw_present:
-            click.echo(f"  X -> {match.raw_file}")
+    if partitions.raw_present:
+        reporting.echo(f"{utils.emphasis_str("Partial Matches")} (only {utils.emphasis_str("RAW")} file present):")
+        for match in partitions.raw_present:
+            reporting.echo(f"  X -> {match.raw_file}")
 
 def perform_cleanup(file_matches: Iterable[FileMatch], test_only: bool):
-    for match in [f for f in file_matches if f.should_remove_raw]:
-        if test_only:
-            click.echo(utils.emphasis_str("TEST "), nl=False)
-        click.echo(f"{utils.emphasis_str("DELETE")} {match.raw_file}... ", nl=False)
+    delete = format_delete(test_only)
+    removed = []
+    for match in file_matches:
+        if not match.should_remove_raw:
+            continue
         if not test_only:
             match.raw_file.unlink()
-        click.echo("OK")
+            removed.append(match.raw_file)
+        reporting.echo(f"{delete} {match.raw_file}... OK")
+        reporting.record("delete", "test" if test_only else "ok", path=match.raw_file)
+    if removed:
+        with covering_catalogs() as catalog_for:
+            if (catalog := catalog_for(removed[0])) is not None:
+                catalog.remove(removed)
+
+def format_delete(test_only: bool) -> str:
+    delete = utils.emphasis_str("DELETE")
+    if test_only:
+        delete = utils.emphasis_str("TEST") + " " + delete
+    return delete
 
 def clean(base_folder: pathlib.Path, raw_folder: pathlib.Path | None, test_only: bool):
     if not base_folder.is_dir():
-        click.echo(utils.error_str("Base folder doesn't exist. Exiting."))
+        reporting.warn(utils.error_str("Base folder doesn't exist. Exiting."))
         return
     
     if raw_folder is None:
-        click.echo("No RAW folder provided. Searching a suitable default... ", nl=False)
+        reporting.echo("No RAW folder provided. Searching a suitable default... ", nl=False)
         raw_folder = find_default_raw_folder(base_folder)
         if raw_folder is not None:
-            click.echo(utils.emphasis_str("OK"))
-            click.echo(f"Using RAW folder '{raw_folder}'.")
+            reporting.echo(utils.emphasis_str("OK"))
+            reporting.echo(f"Using RAW folder '{raw_folder}'.")
         else:
-            click.echo()
-            click.echo(utils.error_str("No suitable RAW image folder found. Exiting."))
+            reporting.echo()
+            reporting.warn(utils.error_str("No suitable RAW image folder found. Exiting."))
             return
     assert raw_folder.is_dir() # This must be true after this point
 
-    click.echo(f"Scanning '{base_folder}' for processed images... ", nl=False)
-    processed_image_files = list(utils.collect_image_files([base_folder], recurse=False, accepted_suffixes=utils.PROCESSED_EXTS))
-    click.echo(f"found {len(processed_image_files)}.")
-    click.echo(f"  {collect_file_suffix_stats(processed_image_files).format_suffixes()}")
+    reporting.echo(f"Scanning '{base_folder}' for processed images... ", nl=False)
+    with reporting.stage("scan"):
+        processed_image_files = list(utils.collect_image_files([base_folder], recurse=False, accepted_suffixes=utils.PROCESSED_EXTS))
+    reporting.echo(f"found {len(processed_image_files)}.")
+    reporting.echo(f"  {collect_file_suffix_stats(processed_image_files).format_suffixes()}")
+
+    reporting.echo(f"Scanning '{raw_folder}' for RAW image files... ", nl=False)
+    with reporting.stage("scan"):
+        raw_image_files = list(utils.collect_image_files([raw_folder], recurse=False, accepted_suffixes=utils.RAW_EXTS))
+    reporting.echo(f"found {len(raw_image_files)}.")
+    reporting.echo(f"  {collect_file_suffix_stats(raw_image_files).format_suffixes()}")
+
+    reporting.echo("Looking for RAW/processed image file pairs... ", nl=False)
+    with reporting.stage("match"):
+        partitions = partition_matches(find_file_matches(processed_image_files, raw_image_files))
+    reporting.echo(f"found {len(partitions.both_present)}.")
 
-    click.echo(f"Scanning '{raw_folder}' for RAW image files... ", nl=False)
-    raw_image_files = list(utils.collect_image_files([raw_folder], recurse=False, accepted_suffixes=utils.RAW_EXTS))
-    click.echo(f"found {len(raw_image_files)}.")
-    click.echo(f"  {collect_file_suffix_stats(raw_image_files).format_suffixes()}")
+    print_matches(partitions)
 
-    click.echo("Looking for RAW/processed image file pairs... ", nl=False)
-    file_matches = find_file_matches(processed_image_files, raw_image_files, raw_folder)
-    click.echo(f"found {len([m for m in file_matches if m.is_matched])}.")
+    reporting.echo("Cleaning up RAW files without a matched processed file...")
+    with reporting.stage("delete"):
+        perform_cleanup(partitions.raw_present, test_only)
 
-    print_matches(file_matches)
 
-    click.echo("Cleaning up RAW files without a matched processed file...")
-    perform_cleanup(file_matches, test_only)
+def clean_folder_pair(pair: FolderPair, test_only: bool) -> FolderCleanup:
+    matched = 0
+    removed = []
+    for match in find_file_matches(pair.processed_files, pair.raw_files):
+        if match.is_matched:
+            matched += 1
+        elif match.should_remove_raw:
+            removed.append(match.raw_file)
+    failures = dict() if test_only else remove_files(pair.raw_folder, removed)
+    return FolderCleanup(pair, matched, removed, failures)
+
+def clean_recursive(root: pathlib.Path, test_only: bool, jobs: int = concurrency.DEFAULT_JOBS):
+    """Clean every folder with a "raw" subfolder under root, several folders at a time."""
+    if not root.is_dir():
+        reporting.warn(utils.error_str("Base folder doesn't exist. Exiting."))
+        return
+
+    reporting.echo(f"Scanning '{root}' for folders with RAW images... ", nl=False)
+    with reporting.stage("scan"):
+        pairs = find_folder_pairs(root, jobs)
+    reporting.echo(f"found {len(pairs)}.")
+
+    pairs_to_clean = []
+    for pair in pairs:
+        if pair.processed_names:
+            pairs_to_clean.append(pair)
+        else:
+            # Most likely RAW-only shots, not processed files deleted one by one
+            reporting.warn(utils.warn_str(f"No processed images in '{pair.base_folder}', leaving its RAW files alone."))
+
+    reporting.count("folders", len(pairs_to_clean))
+    delete = format_delete(test_only)
+    status = "test" if test_only else "ok"
+    removed = failed = 0
+    with concurrency.make_executor(jobs) as executor, covering_catalogs() as catalog_for, reporting.stage("clean"):
+        for cleanup in concurrency.ordered_map(executor, lambda pair: clean_folder_pair(pair, test_only), pairs_to_clean, window=jobs * 4):
+            if not cleanup.removed:
+                continue
+            reporting.echo(f"'{cleanup.pair.base_folder}': {cleanup.matched} pairs, {len(cleanup.removed)} RAW files without a processed file")
+            for raw_file in cleanup.removed:
+                err = cleanup.failures.get(raw_file)
+                if err is None:
+                    reporting.echo(f"  {delete} {raw_file}... {utils.emphasis_str("OK")}")
+                    reporting.record("delete", status, path=raw_file)
+                else:
+                    reporting.warn(f"  {delete} {raw_file}... {utils.error_str(str(err))}")
+                    reporting.record("delete", "error", path=raw_file, error=str(err))
+            if not test_only and (catalog := catalog_for(cleanup.removed[0])) is not None:
+                catalog.remove(file for file in cleanup.removed if file not in cleanup.failures)
+            removed += len(cleanup.removed) - len(cleanup.failures)
+            failed += len(cleanup.failures)
 
+    reporting.echo(f"{"Would remove" if test_only else "Removed"} {removed} RAW files in {len(pairs_to_clean)} folders.")
+    if failed:
+        reporting.warn(utils.error_str(f"{failed} RAW files could not be removed."))
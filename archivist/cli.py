@@ -1,15 +1,36 @@
-import pathlib
+import pathlib, re, sys
 import click
 
 from typing import Iterable
 
-from . import import_command, clean_command, count_command, normalize_command, plot_command
+# Command modules are imported by their commands, so each command only loads what it needs
+from . import constants, instrumentation, reporting
 
 
+def run_startup_profile(ctx: click.Context, param: click.Parameter, value: bool):
+    if not value or ctx.resilient_parsing:
+        return
+    from . import startup_profile
+    args = [arg for arg in sys.argv[1:] if arg != "--startup-profile"]
+    ctx.exit(startup_profile.profile_startup(args))
+
 @click.group()
 @click.version_option()
-def cli():
-    pass
+@click.option("--startup-profile", is_flag=True, is_eager=True, expose_value=False, callback=run_startup_profile,
+              help="Run the command, then report how long importing each module took at startup")
+@click.option("--output", default="text", show_default=True, type=click.Choice(reporting.OUTPUT_MODES),
+              help="Print human-readable text, one JSON document or JSON lines with a record per file and a final summary, or only warnings and errors")
+@click.option("--profile", type=click.Choice(instrumentation.PROFILE_MODES),
+              help="Time the stages and hot functions of the run: print a summary with counters, or write a cProfile dump or a Chrome trace")
+@click.option("--profile-file", type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help="File to write the cProfile dump or trace to [default: archivist.pstats or archivist-trace.json]")
+@click.pass_context
+def cli(ctx: click.Context, output: str, profile: str | None, profile_file: pathlib.Path | None):
+    if profile is not None:
+        # Registered first, so it finishes after the reporter and sees all of its output
+        ctx.call_on_close(instrumentation.enable(profile, profile_file).finish)
+    reporter = reporting.use(reporting.Reporter(output, ctx.invoked_subcommand))
+    ctx.call_on_close(reporter.finish)
 
 @cli.command(name="import")
 @click.argument("files", nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path))
@@ -18,53 +39,167 @@ def cli():
 @click.option("-m", "--move", is_flag=True, help="Move files instead of copying them (CARE: deletes the originals)")
 @click.option("-o", "--files-only", is_flag=True, help="Only process file paths, ignore any given directory paths")
 @click.option("-r", "--recurse", is_flag=True, help="Read image files recursively from any given directories")
-def import_files(files: Iterable[pathlib.Path], archive: pathlib.Path, test: bool, move: bool, files_only: bool, recurse: bool):
-    """Collect image files and import them into an archive folder, according to their capture date and time."""
-    import_command.import_files(archive, files, move, files_only, recurse, test)
+@click.option("--no-cache", is_flag=True, help="Don't use the archive's metadata cache")
+@click.option("--rebuild-cache", is_flag=True, help="Discard the archive's metadata cache and read all metadata afresh")
+@click.option("-j", "--jobs", default=constants.DEFAULT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of parallel workers reading image metadata")
+@click.option("--processes", is_flag=True, help="Read image metadata in worker processes instead of threads")
+@click.option("-s", "--stream", is_flag=True, help="Start importing files as soon as they are found, showing progress and throughput")
+@click.option("--copy-jobs", default=constants.DEFAULT_COPY_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of files copied concurrently")
+@click.option("-d", "--skip-duplicates", is_flag=True, help="Skip files whose contents already exist in the archive (maintains a content index in the archive)")
+@click.option("--resume", is_flag=True, help="Complete an interrupted import into the archive, as recorded in its journal (any FILES are ignored)")
+@click.option("-V", "--verify", is_flag=True, help="Check every copy read back from disk against the data read from the original before removing any originals, and keep the checksums for audit")
+def import_files(files: Iterable[pathlib.Path], archive: pathlib.Path, test: bool, move: bool, files_only: bool, recurse: bool, no_cache: bool, rebuild_cache: bool, jobs: int, processes: bool, stream: bool, copy_jobs: int, skip_duplicates: bool, resume: bool, verify: bool):
+    """
+    Collect image files and import them into an archive folder, according to their capture date and time.
+
+    Every import is recorded in a journal in the archive. If an import is interrupted, run again with --resume to complete it.
+    """
+    from . import import_command
+    import_command.import_files(archive, files, move, files_only, recurse, test, no_cache, rebuild_cache, jobs, processes, stream, copy_jobs, skip_duplicates, resume, verify)
+
+@cli.command()
+@click.argument("inboxes", nargs=-1, required=True, type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path))
+@click.option("-a", "--archive", default=".", type=click.Path(file_okay=False, path_type=pathlib.Path), help="Path to the archive directory")
+@click.option("-m", "--move", is_flag=True, help="Move files instead of copying them (CARE: deletes the originals)")
+@click.option("-r", "--recurse", is_flag=True, help="Watch subdirectories of the inboxes, too")
+@click.option("--settle-time", default=constants.DEFAULT_SETTLE_TIME, show_default=True, type=click.FloatRange(min=0), help="Seconds a file's size and modification time must stay the same before it's imported")
+@click.option("--poll", is_flag=True, help="Rescan the inboxes periodically instead of using inotify, e.g. for network shares")
+@click.option("--poll-interval", default=constants.DEFAULT_POLL_INTERVAL, show_default=True, type=click.FloatRange(min=0.1), help="Seconds between rescans when polling")
+@click.option("--batch-size", default=constants.DEFAULT_BATCH_SIZE, show_default=True, type=click.IntRange(min=1), help="Maximum number of files imported in one go")
+@click.option("--no-cache", is_flag=True, help="Don't use the archive's metadata cache")
+@click.option("-j", "--jobs", default=constants.DEFAULT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of parallel workers reading image metadata")
+@click.option("--copy-jobs", default=constants.DEFAULT_COPY_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of files copied concurrently")
+@click.option("-V", "--verify", is_flag=True, help="Check every copy read back from disk against the data read from the original before removing any originals, and keep the checksums for audit")
+def watch(inboxes: Iterable[pathlib.Path], archive: pathlib.Path, move: bool, recurse: bool, settle_time: float, poll: bool, poll_interval: float, batch_size: int, no_cache: bool, jobs: int, copy_jobs: int, verify: bool):
+    """
+    Watch inbox folders and import image files into an archive folder as they arrive, until stopped with Ctrl+C.
+
+    Files are imported once they're completely written, and skipped if their contents are already in the archive
+    (so files left in an inbox aren't imported twice).
+    """
+    from . import watch_command
+    watch_command.watch(archive, inboxes, move, recurse, settle_time, poll, poll_interval, batch_size, no_cache, jobs, copy_jobs, verify)
 
 @cli.command()
 @click.argument("processed_images_dir", nargs=1, default=".", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path))
 @click.option("-d", "--raw-dir", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path), help="Directory containing RAW image files to be cleaned up")
 @click.option("-t", "--test", is_flag=True, help="Print proposed actions, but don't actually do anything")
-def clean(processed_images_dir: pathlib.Path, raw_dir: pathlib.Path | None, test: bool):
+@click.option("-r", "--recurse", is_flag=True, help="Clean every folder with a \"raw\" subfolder under PROCESSED_IMAGES_DIR, e.g. a whole archive")
+@click.option("-j", "--jobs", default=constants.DEFAULT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of folders cleaned in parallel with --recurse")
+def clean(processed_images_dir: pathlib.Path, raw_dir: pathlib.Path | None, test: bool, recurse: bool, jobs: int):
     """
     Clean up raw image files whose paired jpegs have been deleted.
 
     By default, processed images will be collected from the current working directory.
     If --raw-dir isn't given, this command will look for a suitable folder of RAW images -
     such as a subfolder of the PROCESSED_IMAGES_DIR named "raw".
+    With --recurse, all such folder pairs below PROCESSED_IMAGES_DIR are cleaned in one go.
     """
-    clean_command.clean(processed_images_dir, raw_dir, test)
+    from . import clean_command
+    if recurse:
+        if raw_dir is not None:
+            raise click.UsageError("--raw-dir can't be combined with --recurse.")
+        clean_command.clean_recursive(processed_images_dir, test, jobs)
+    else:
+        clean_command.clean(processed_images_dir, raw_dir, test)
 
 @cli.command()
 @click.argument("paths", nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path))
 @click.option("-n/-l", "--normalize/--no-normalize", default=True, help="Normalize file suffixes, e.g. .JPG -> .jpeg")
-def count(paths: Iterable[pathlib.Path], normalize: bool):
+@click.option("-c", "--catalog", "use_catalog", is_flag=True, help="Count from the catalog of the archive the paths are in, instead of scanning them")
+def count(paths: Iterable[pathlib.Path], normalize: bool, use_catalog: bool):
     """
     Count image files found under the given paths.
     
     Both directory as well as file paths can be passed to this command - it'll sum it all up.
     File suffixes will be normalized by default so as not to end up with a statistic full of .JPG, .jpg, .jpeg, and so on.
     """
-    count_command.count(paths, normalize)
+    from . import count_command
+    count_command.count(paths, normalize, use_catalog)
 
 @cli.command()
 @click.argument("paths", nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path))
 @click.option("-r", "--recurse", is_flag=True, help="Read image files recursively from any given directories")
 @click.option("-t", "--test", is_flag=True, help="Print proposed actions, but don't actually do anything")
-def normalize(paths: Iterable[pathlib.Path], recurse: bool, test: bool):
+@click.option("-j", "--jobs", default=constants.DEFAULT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of folders listed and renamed in parallel")
+def normalize(paths: Iterable[pathlib.Path], recurse: bool, test: bool, jobs: int):
     """
     Normalize file extensions by renaming (image) files (e.g. .JPG -> .jpeg), while attempting to preserve file attributes.
     
     Works with any number of file or directory path arguments. Everything will be renamed in-place.
+    Files whose new name is already taken are skipped, and files that can't be renamed are reported without stopping the run.
     """
-    normalize_command.normalize(paths, recurse, test)
+    from . import normalize_command
+    normalize_command.normalize(paths, recurse, test, jobs)
 
 @cli.command()
 @click.argument("folders", nargs=-1,  type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path))
 @click.option("-o", "--out-file", type=click.Path(dir_okay=False, path_type=pathlib.Path), help="Save the generated plot to the given file path (instead of opening it straight away)")
 @click.option("-r", "--raw-only", is_flag=True, help="Only read data from raw file formats (such as .RAF, .NEF, etc.)")
 @click.option("-p", "--processed-only", is_flag=True, help="Only read data from processed file formats (such as JPEG)")
-def plot(folders: Iterable[pathlib.Path], out_file: pathlib.Path | None, raw_only: bool, processed_only: bool):
-    """Plot focal length distribution of image files."""
-    plot_command.plot(folders, out_file, raw_only, processed_only)
+@click.option("-a", "--archive", type=click.Path(file_okay=False, path_type=pathlib.Path), help="Path to the archive directory holding the metadata cache and catalog [default: the archive the FOLDERS are in, if it has them]")
+@click.option("--no-cache", is_flag=True, help="Don't use the archive's metadata cache")
+@click.option("--rebuild-cache", is_flag=True, help="Discard the archive's metadata cache and read all metadata afresh")
+@click.option("-j", "--jobs", default=constants.DEFAULT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of parallel workers reading image metadata")
+@click.option("--processes", is_flag=True, help="Read image metadata in worker processes instead of threads")
+@click.option("-D", "--dimension", default="focal_length", show_default=True, type=click.Choice(constants.DIMENSION_NAMES), help="Image metadata to plot the distribution of")
+@click.option("-g", "--group-by", default="none", show_default=True, type=click.Choice(constants.GROUPING_NAMES), help="Plot a separate series per folder or capture year")
+@click.option("-c", "--catalog", "use_catalog", is_flag=True, help="Read metadata from the archive's catalog instead of the files (all of the archive if no FOLDERS are given), if there is one covering the FOLDERS")
+def plot(folders: Iterable[pathlib.Path], out_file: pathlib.Path | None, raw_only: bool, processed_only: bool, archive: pathlib.Path | None, no_cache: bool, rebuild_cache: bool, jobs: int, processes: bool, dimension: str, group_by: str, use_catalog: bool):
+    """Plot the distribution of focal lengths (or other metadata) of image files."""
+    from . import plot_command
+    plot_command.plot(folders, out_file, raw_only, processed_only, archive, no_cache, rebuild_cache, jobs, processes, dimension, group_by, use_catalog)
+
+def validate_date(ctx: click.Context, param: click.Parameter, value: str | None) -> str | None:
+    if value is not None and not re.match(r"^\d{4}(-\d{2}(-\d{2})?)?$", value):
+        raise click.BadParameter("use YYYY, YYYY-MM or YYYY-MM-DD")
+    return value
+
+def parse_range(ctx: click.Context, param: click.Parameter, value: str | None) -> tuple[int, int] | None:
+    if value is None:
+        return None
+    match = re.match(r"^(\d+)(?:-(\d+))?$", value)
+    if not match:
+        raise click.BadParameter("use a number like 35, or a range like 24-70")
+    return int(match[1]), int(match[2] or match[1])
+
+@cli.command()
+@click.option("-a", "--archive", default=".", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path), help="Path to the archive directory")
+@click.option("-f", "--from", "start", callback=validate_date, help="Captured on or after this date (YYYY, YYYY-MM or YYYY-MM-DD)")
+@click.option("-u", "--until", "end", callback=validate_date, help="Captured on or before this date (YYYY, YYYY-MM or YYYY-MM-DD)")
+@click.option("-C", "--camera", help="Camera make or model contains this text")
+@click.option("-L", "--lens", help="Lens model contains this text")
+@click.option("-F", "--focal-length", callback=parse_range, help="35mm equivalent focal length, or a range of them, e.g. 24-70")
+@click.option("-s", "--suffix", "suffixes", multiple=True, help="File suffix, e.g. raf or .jpeg (repeatable)")
+@click.option("-l", "--long", is_flag=True, help="Show capture time, camera and exposure details with each file")
+@click.option("-n", "--count", "count_only", is_flag=True, help="Only print the number of matching files")
+@click.option("--full-refresh", is_flag=True, help="Check every file for changes, not only folders whose contents changed")
+@click.option("-j", "--jobs", default=constants.DEFAULT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of parallel workers reading image metadata")
+@click.argument("folders", nargs=-1, type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path))
+def query(archive: pathlib.Path, start: str | None, end: str | None, camera: str | None, lens: str | None, focal_length: tuple[int, int] | None,
+          suffixes: tuple[str, ...], long: bool, count_only: bool, full_refresh: bool, jobs: int, folders: Iterable[pathlib.Path]):
+    """
+    Find image files in an archive by capture date, camera, lens, focal length and suffix, optionally only below FOLDERS.
+
+    Answers come from a catalog kept in the archive, which is built on first use and then only updated with what changed.
+    It's kept up to date by import, clean and normalize, too.
+    """
+    from . import query_command
+    from .catalog import Filters
+    filters = Filters(list(folders), set(suffixes), start, end, camera, lens, focal_length)
+    query_command.query(archive, filters, long, count_only, full_refresh, jobs)
+
+@cli.command()
+@click.option("-a", "--archive", default=".", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path), help="Path to the archive directory")
+@click.option("-j", "--jobs", default=constants.DEFAULT_AUDIT_JOBS, show_default=True, type=click.IntRange(min=1), help="Number of files read concurrently")
+@click.option("--max-rate", type=click.FloatRange(min=0, min_open=True), help="Read at most this many MB/s in total, to leave the disk usable for other work")
+@click.pass_context
+def audit(ctx: click.Context, archive: pathlib.Path, jobs: int, max_rate: float | None):
+    """
+    Check the files in an archive for silent corruption (bit rot), by reading them back from disk and comparing them with their checksums.
+
+    Checksums are recorded by import --verify, and by the first audit of files without one. Exits with status 1 if any files are corrupt.
+    """
+    from . import audit_command
+    if audit_command.audit(archive, jobs, max_rate):
+        ctx.exit(1)
@@ -0,0 +1,77 @@
+import queue, threading
+
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+from .constants import DEFAULT_JOBS
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class InlineExecutor(Executor):
+    """Executor running everything immediately in the calling thread - for --jobs 1."""
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+        return future
+
+
+def make_executor(jobs: int, processes: bool = False) -> Executor:
+    if jobs <= 1:
+        return InlineExecutor()
+    elif processes:
+        # Imported on demand, as it pulls in multiprocessing
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Never plain fork: other threads (e.g. of import --stream) may hold locks or sqlite connections at that moment,
+        # which the workers would inherit in whatever state they're in
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(method))
+    else:
+        return ThreadPoolExecutor(max_workers=jobs)
+
+def completed(result: R) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+def ordered_results(futures: Iterable[Future], window: int) -> Iterator:
+    """Resolve futures in submission order, keeping at most `window` of them in flight."""
+    pending = deque()
+    for future in futures:
+        pending.append(future)
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def ordered_map(executor: Executor, fn: Callable[[T], R], items: Iterable[T], window: int) -> Iterator[R]:
+    """Like Executor.map, but consumes the input lazily, so it can stream through unbounded iterables."""
+    return ordered_results((executor.submit(fn, item) for item in items), window)
+
+def background(items: Iterable[T], maxsize: int) -> Iterator[T]:
+    """Run an iterable on a separate thread, handing its items over through a bounded queue."""
+    handover = queue.Queue(maxsize)
+    done = object()
+    failure = []
+
+    def produce():
+        try:
+            for item in items:
+                handover.put(item)
+        except BaseException as err:
+            failure.append(err)
+        finally:
+            handover.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while (item := handover.get()) is not done:
+        yield item
+    if failure:
+        raise failure[0]
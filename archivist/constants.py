@@ -0,0 +1,16 @@
+import os
+
+# Defaults and choices of the command line options, kept apart from the modules using them,
+# so the command line can offer them without importing those modules before a command runs
+
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+DEFAULT_COPY_JOBS = 4
+DEFAULT_AUDIT_JOBS = 2
+
+DEFAULT_SETTLE_TIME = 2.0
+DEFAULT_POLL_INTERVAL = 5.0
+DEFAULT_BATCH_SIZE = 100
+
+# Keys of aggregation.DIMENSIONS and aggregation.GROUPINGS
+DIMENSION_NAMES = ["focal_length", "aperture", "iso", "camera", "lens", "hour", "month"]
+GROUPING_NAMES = ["none", "folder", "year"]
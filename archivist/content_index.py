@@ -0,0 +1,176 @@
+import contextlib, hashlib, os, pathlib, sqlite3
+
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterable, Mapping
+
+from . import instrumentation, utils
+
+INDEX_FILE_NAME = ".archivist-index.sqlite3"
+QUICK_HASH_BLOCK_SIZE = 64 * 1024
+
+
+@instrumentation.instrumented("quick_hash")
+def quick_hash(file: pathlib.Path, size: int) -> str:
+    """Hash of the first and last block of a file - cheap, and enough to tell almost all same-sized files apart."""
+    digest = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=16)
+    with file.open("rb") as fo:
+        digest.update(fo.read(QUICK_HASH_BLOCK_SIZE))
+        if size > QUICK_HASH_BLOCK_SIZE:
+            fo.seek(max(QUICK_HASH_BLOCK_SIZE, size - QUICK_HASH_BLOCK_SIZE))
+            digest.update(fo.read(QUICK_HASH_BLOCK_SIZE))
+    instrumentation.add("hash_bytes_read", min(size, 2 * QUICK_HASH_BLOCK_SIZE))
+    return digest.hexdigest()
+
+@instrumentation.instrumented("full_hash")
+def full_hash(file: pathlib.Path) -> str:
+    with file.open("rb") as fo:
+        digest = hashlib.file_digest(fo, "blake2b").hexdigest()
+        instrumentation.add("hash_bytes_read", fo.tell())
+        return digest
+
+
+@dataclass(slots=True)
+class IndexEntry:
+    path: pathlib.Path
+    size: int
+    quick_hash: str | None = None
+    full_hash: str | None = None
+
+
+class ContentIndex:
+    """
+    Archive-wide index of file contents, used to find files that already exist in the archive.
+
+    Files are compared by size first. Only when sizes match are the first and last blocks hashed,
+    and only when those match, the full contents. Hashes are computed lazily and stored.
+    """
+
+    def __init__(self, archive: pathlib.Path):
+        self.archive = archive
+        self.computed_hashes = 0
+        self._batch: dict[int, list[IndexEntry]] = defaultdict(list)
+        self._connection = sqlite3.connect(archive / INDEX_FILE_NAME)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS content (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, quick_hash TEXT, full_hash TEXT)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS content_size ON content (size)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def refresh(self) -> int:
+        """
+        Bring the index in line with the files in the archive, listing only the folders changed since the last refresh
+        like Catalog.refresh does. Returns the number of new or changed files.
+        """
+        known_folders = {path: (parent, mtime_ns) for path, parent, mtime_ns in self._connection.execute("SELECT path, parent, mtime_ns FROM folders")}
+        changed = []
+        removed = []
+        folder_rows = []
+        visited = set()
+        for folder, parent, mtime_ns, files in utils.scan_changed_folders(self.archive, known_folders):
+            visited.add(folder)
+            if files is None:
+                continue
+            start, end = utils.prefix_range(folder)
+            # Only the files directly in the folder, not the ones in its subfolders
+            known_files = {path: (size, mtime_ns) for path, size, mtime_ns in self._connection.execute(
+                "SELECT path, size, mtime_ns FROM content WHERE path >= ? AND path < ? AND instr(substr(path, ?), ?) = 0",
+                (start, end, len(start) + 1, os.sep))}
+            for entry in files:
+                if utils.has_accepted_suffix(entry.name, utils.IMAGE_EXTS):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if known_files.pop(entry.path, None) != (stat.st_size, stat.st_mtime_ns):
+                        changed.append((entry.path, stat.st_size, stat.st_mtime_ns))
+            removed.extend(known_files)
+            folder_rows.append((folder, parent, mtime_ns))
+
+        if not known_folders:
+            # Nothing to tell which folders are gone, so drop the files of any folder not found
+            removed.extend(path for path, in self._connection.execute("SELECT path FROM content") if os.path.dirname(path) not in visited)
+        gone_folders = known_folders.keys() - visited
+        self._connection.executemany("INSERT OR REPLACE INTO content VALUES (?, ?, ?, NULL, NULL)", changed)
+        self._connection.executemany("DELETE FROM content WHERE path = ?", ((path,) for path in removed))
+        self._connection.executemany("DELETE FROM content WHERE path >= ? AND path < ?", (utils.prefix_range(folder) for folder in gone_folders))
+        self._connection.executemany("DELETE FROM folders WHERE path = ?", ((folder,) for folder in gone_folders))
+        self._connection.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", folder_rows)
+        self._connection.commit()
+        return len(changed)
+
+    def add(self, files: Iterable[pathlib.Path], full_hashes: Mapping[pathlib.Path, str] | None = None):
+        """
+        Index files just imported into the archive, replacing the ones remembered as about to be imported.
+        Full hashes computed while importing are kept, as the reference for audits.
+        """
+        full_hashes = full_hashes or {}
+        rows = []
+        for file in files:
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            rows.append((str(file.absolute()), stat.st_size, stat.st_mtime_ns, full_hashes.get(file)))
+        self._connection.executemany("INSERT OR REPLACE INTO content VALUES (?, ?, ?, NULL, ?)", rows)
+        self._connection.commit()
+        self._batch.clear()
+
+    def entries(self) -> list[IndexEntry]:
+        return [IndexEntry(pathlib.Path(path), size, quick, full) for path, size, quick, full in
+                self._connection.execute("SELECT path, size, quick_hash, full_hash FROM content ORDER BY path")]
+
+    def set_full_hash(self, file: pathlib.Path, full_hash: str):
+        self._connection.execute("UPDATE content SET full_hash = ? WHERE path = ?", (full_hash, str(file.absolute())))
+
+    @instrumentation.instrumented("find_duplicate")
+    def find_duplicate(self, file: pathlib.Path, stat: os.stat_result) -> pathlib.Path | None:
+        """
+        Return a file in the archive with the same contents, if there is one.
+
+        Files without a duplicate are remembered as about to be imported, so later copies of them in the same run are found, too.
+        Only files that are imported unless they're duplicates should be looked up.
+        """
+        entry = IndexEntry(file, stat.st_size)
+        rows = self._connection.execute("SELECT path, quick_hash, full_hash FROM content WHERE size = ?", (stat.st_size,)).fetchall()
+        candidates = [IndexEntry(pathlib.Path(path), stat.st_size, quick, full) for path, quick, full in rows]
+        candidates.extend(self._batch[stat.st_size])
+        for candidate in candidates:
+            try:
+                if self._hash(candidate, full=False) != self._hash(entry, full=False):
+                    continue
+                if self._hash(candidate, full=True) == self._hash(entry, full=True):
+                    return candidate.path
+            except OSError:
+                continue
+        self._batch[stat.st_size].append(entry)
+        return None
+
+    def _hash(self, entry: IndexEntry, full: bool) -> str:
+        if full and entry.full_hash is None:
+            entry.full_hash = full_hash(entry.path)
+        elif not full and entry.quick_hash is None:
+            entry.quick_hash = quick_hash(entry.path, entry.size)
+        else:
+            return entry.full_hash if full else entry.quick_hash
+        self.computed_hashes += 1
+        self._connection.execute("UPDATE content SET quick_hash = ?, full_hash = ? WHERE path = ?",
+                                 (entry.quick_hash, entry.full_hash, str(entry.path.absolute())))
+        return entry.full_hash if full else entry.quick_hash
+
+
+def open_index(archive: pathlib.Path, enabled: bool) -> contextlib.AbstractContextManager[ContentIndex | None]:
+    if not enabled or not archive.is_dir():
+        return contextlib.nullcontext(None)
+    else:
+        return ContentIndex(archive)
@@ -1,11 +1,10 @@
 import pathlib
-import click
 
 from collections import Counter
 from dataclasses import dataclass
 from typing import Iterable, Tuple
 
-from . import utils
+from . import reporting, utils
 
 
 @dataclass
@@ -20,15 +19,40 @@ class SuffixStats:
         return f"TOTAL: {self.total_count}"
 
 
-def collect_file_suffix_stats(files: Iterable[pathlib.Path]) -> SuffixStats:
-    suffixes = (file.suffix for file in files)
-    suffix_counter = Counter(suffixes)
-    return SuffixStats(sum(suffix_counter.values()), suffix_counter.most_common())
-
-def count(paths: Iterable[pathlib.Path], normalize: bool):
-    image_files = utils.collect_image_files(paths, recurse=True)
-    if normalize:
-        image_files = map(utils.normalize_suffix, image_files)
-    stats = collect_file_suffix_stats(image_files)
-    click.echo(stats.format_suffixes())
-    click.echo(stats.format_total())
+def collect_file_suffix_stats(files: Iterable[pathlib.Path], normalize: bool = False) -> SuffixStats:
+    # Count the raw suffixes first, so normalization happens once per distinct suffix rather than once per file
+    return suffix_stats(Counter(file.suffix for file in files).items(), normalize)
+
+def suffix_stats(suffix_counts: Iterable[tuple[str, int]], normalize: bool = False) -> SuffixStats:
+    suffix_counter = Counter()
+    for suffix, count in suffix_counts:
+        suffix_counter[utils.normalize_suffix_str(suffix) if normalize else suffix] += count
+    return SuffixStats(suffix_counter.total(), suffix_counter.most_common())
+
+def collect_catalog_suffix_stats(paths: list[pathlib.Path], normalize: bool) -> SuffixStats | None:
+    """Count from the catalog of the archive the paths are in, if they are all folders of one archive with a catalog."""
+    from .catalog import Catalog, Filters, find_common_catalog_root # Loads sqlite3, so only with --catalog
+    from .metadata_cache import find_cache_root, open_cache
+    root = find_common_catalog_root(paths)
+    if root is None or not all(path.is_dir() for path in paths):
+        return None
+    with Catalog(root) as catalog, open_cache(find_cache_root([root]), False, False) as cache:
+        catalog.refresh(cache=cache)
+        return suffix_stats(catalog.suffix_counts(Filters(folders=paths)), normalize)
+
+def count(paths: Iterable[pathlib.Path], normalize: bool, use_catalog: bool = False):
+    paths = list(paths)
+    stats = None
+    if use_catalog:
+        with reporting.stage("catalog"):
+            stats = collect_catalog_suffix_stats(paths, normalize)
+        if stats is None:
+            reporting.warn(utils.warn_str("No catalog covers all the given paths - scanning them instead."))
+    if stats is None:
+        with reporting.stage("collect"):
+            image_files = utils.collect_image_files(paths, recurse=True)
+            stats = collect_file_suffix_stats(image_files, normalize)
+    for suffix, suffix_count in stats.suffix_counts:
+        reporting.count(suffix, suffix_count)
+    reporting.echo(stats.format_suffixes())
+    reporting.echo(stats.format_total())
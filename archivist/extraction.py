@@ -0,0 +1,65 @@
+import os, pathlib
+
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, Mapping
+
+from . import concurrency, utils
+from .metadata_cache import MetadataCache
+
+
+@dataclass(slots=True)
+class FileMetadata:
+    path: pathlib.Path
+    tags: dict[str, Any] | None
+    warnings: list[str] = field(default_factory=list)
+
+
+def read_file_metadata(file: pathlib.Path, tags: tuple[str, ...]) -> FileMetadata:
+    try:
+        return FileMetadata(file, utils.read_exif_tags_uncached(file, tags))
+    except utils.ExifReadError as err:
+        return FileMetadata(file, None, [utils.warn_str(str(err))])
+    except OSError as err:
+        return FileMetadata(file, None, [utils.warn_str(f"Unable to read file '{file}': {err}")])
+
+def extract_metadata(files: Iterable[pathlib.Path],
+                     tags: Iterable[str],
+                     cache: MetadataCache | None = None,
+                     jobs: int = concurrency.DEFAULT_JOBS,
+                     processes: bool = False,
+                     file_stats: Mapping[pathlib.Path, os.stat_result] | None = None) -> Iterator[FileMetadata]:
+    """
+    Read EXIF tags of many files on a worker pool, yielding results in input order.
+
+    Cache lookups and updates happen on the calling thread, reusing stat results from file_stats where given.
+    Warnings are collected per file instead of being printed.
+    """
+    tags = tuple(tags)
+    read_tags = tags if cache is None else cache.tags_to_read(tags)
+    stats: dict[pathlib.Path, os.stat_result] = {}
+
+    def submit(executor, file: pathlib.Path) -> Future:
+        if cache is not None:
+            try:
+                stat = file_stats[file] if file_stats and file in file_stats else file.stat()
+            except OSError as err:
+                return concurrency.completed(FileMetadata(file, None, [utils.warn_str(f"Unable to read file '{file}': {err}")]))
+            values = cache.get(file, stat, tags)
+            if values is not MetadataCache.MISS:
+                return concurrency.completed(FileMetadata(file, values))
+            stats[file] = stat
+        return executor.submit(read_file_metadata, file, read_tags)
+
+    def finish(result: FileMetadata) -> FileMetadata:
+        stat = stats.pop(result.path, None)
+        if stat is not None and not result.warnings:
+            cache.put(result.path, stat, result.tags)
+        if result.tags is not None and len(result.tags) != len(tags):
+            result.tags = {tag: result.tags[tag] for tag in tags}
+        return result
+
+    with concurrency.make_executor(jobs, processes) as executor:
+        futures = (submit(executor, file) for file in files)
+        for result in concurrency.ordered_results(futures, window=max(1, jobs) * 4):
+            yield finish(result)
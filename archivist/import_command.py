@@ -1,97 +1,457 @@
-import datetime, pathlib, shutil
-import click
+import contextlib, datetime, os, pathlib, re
 
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Callable, Iterable, Iterator
 
-from . import utils
+from . import concurrency, extraction, instrumentation, integrity, reporting, transfer, utils
+from .catalog import Catalog, open_catalog
+from .content_index import ContentIndex, full_hash, open_index
+from .journal import ImportJournal
+from .metadata_cache import MetadataCache, open_cache
+from .progress import Progress
 
+STREAM_QUEUE_SIZE = 1024
+CANONICAL_NAME = re.compile(r"^(\d{8}_\d{2}_\d{2}_\d{2})(?:-(\d+))?(\.[^.]+)$")
 
-@dataclass
+
+@dataclass(slots=True)
 class ImportOperation:
     original_path: pathlib.Path
-    canonical_path: pathlib.Path
+    canonical_folder: pathlib.Path
+    canonical_name: str
+
+    @property
+    def canonical_path(self) -> pathlib.Path:
+        # Made on demand, so the operations of a folder share a single path object
+        return self.canonical_folder / self.canonical_name
 
-@dataclass
+@dataclass(slots=True)
 class ImportFile:
     path: pathlib.Path
     capture_time: datetime.datetime
 
+@dataclass(slots=True)
+class TransferResult:
+    operation: ImportOperation
+    canonical_path: pathlib.Path
+    size: int | None = None
+    checksum: str | None = None
+    error: OSError | None = None
+
+
+def filter_duplicates(import_files: Iterable[ImportFile],
+                      file_stats: dict[pathlib.Path, os.stat_result],
+                      index: ContentIndex,
+                      report: Callable[[str], None] = reporting.echo) -> Iterable[ImportFile]:
+    """
+    Drop files already in the archive, or earlier in the same run. Only pass files that are planned if kept, as those
+    are remembered as about to be imported.
+    """
+    for import_file in import_files:
+        duplicate = index.find_duplicate(import_file.path, file_stats[import_file.path])
+        if duplicate is not None:
+            report(f"{utils.emphasis_str("SKIP")} {import_file.path}: already in archive as '{duplicate}'.")
+            reporting.record("skip", path=import_file.path, duplicate=duplicate)
+        else:
+            yield import_file
 
-def read_datetime(file: pathlib.Path) -> datetime.datetime | None:
-    exif_data = utils.read_exif_tag(file, "datetime_original")
+def parse_datetime(exif_data: str | None) -> datetime.datetime | None:
     if exif_data is None:
         return None
     else:
         return datetime.datetime.strptime(exif_data, "%Y:%m:%d %H:%M:%S")
 
-def process_input_files(image_files: Iterable[pathlib.Path]) -> Iterable[ImportFile]:
-    def process_file(file: pathlib.Path) -> ImportFile:
-        capture_time = read_datetime(file)
+def read_datetime(file: pathlib.Path, cache: MetadataCache | None = None) -> datetime.datetime | None:
+    return parse_datetime(utils.read_exif_tag(file, "datetime_original", cache))
+
+@instrumentation.instrumented("process_input_files")
+def process_input_files(image_files: Iterable[pathlib.Path],
+                        cache: MetadataCache | None = None,
+                        jobs: int = concurrency.DEFAULT_JOBS,
+                        processes: bool = False,
+                        file_stats: dict[pathlib.Path, os.stat_result] | None = None) -> Iterable[ImportFile]:
+    import_files = []
+    warnings = []
+    for result in extraction.extract_metadata(image_files, ["datetime_original"], cache, jobs, processes, file_stats):
+        warnings.extend(result.warnings)
+        capture_time = parse_datetime(result.tags["datetime_original"] if result.tags else None)
         if capture_time is None:
-            click.echo(utils.warn_str(f"No capture time on file '{file}' - skipping."))
-            return None
-        return ImportFile(file, capture_time)
-    
-    return list(filter(bool, map(process_file, image_files)))
+            warnings.append(utils.warn_str(f"No capture time on file '{result.path}' - skipping."))
+            reporting.record("skip", path=result.path, reason="no capture time")
+        else:
+            import_files.append(ImportFile(result.path, capture_time))
 
-def make_import_operations(archive: pathlib.Path, files: Iterable[ImportFile]) -> Iterable[ImportOperation]:
-    def make_operation(file: pathlib.Path, name_counts: dict[pathlib.Path, int]) -> ImportOperation:
+    for warning in warnings:
+        reporting.warn(warning)
+    return import_files
+
+class ImportPlanner:
+    """
+    Assigns canonical archive paths to files, numbering files that share a capture time in the order they're planned.
+    Numbering continues after the files already in the archive, which are counted once per archive folder,
+    and again by refresh if the folder changed since.
+    """
+
+    def __init__(self, archive: pathlib.Path):
+        self.archive = archive
+        self.name_counts: dict[str, int] = dict()
+        # Archive folders by "YYYY/MM", seeded on first use
+        self.folders: dict[str, pathlib.Path] = dict()
+        # Modification times of the folders when they were seeded, None if they didn't exist
+        self.folder_mtimes: dict[pathlib.Path, int | None] = dict()
+
+    def seed(self, folder: pathlib.Path):
+        try:
+            # Taken before listing, so changes made while listing show up in the next refresh
+            self.folder_mtimes[folder] = folder.stat().st_mtime_ns
+            names = os.listdir(folder)
+        except OSError:
+            self.folder_mtimes[folder] = None
+            return
+        for name in names:
+            match = CANONICAL_NAME.match(name)
+            if match:
+                base, number, suffix = match.groups()
+                key = base + utils.normalize_suffix_str(suffix)
+                self.name_counts[key] = max(self.name_counts.get(key, 0), int(number) + 1 if number else 1)
+
+    def refresh(self):
+        """Seed the folders changed since they were seeded again, e.g. by another import into the archive."""
+        for folder, mtime in self.folder_mtimes.items():
+            try:
+                current = folder.stat().st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                self.seed(folder)
+
+    def plan(self, file: ImportFile) -> ImportOperation:
+        year_month = file.capture_time.strftime("%Y/%m")
+        folder = self.folders.get(year_month)
+        if folder is None:
+            folder = self.folders[year_month] = self.archive / year_month
+            self.seed(folder)
         name = file.capture_time.strftime("%Y%m%d_%H_%M_%S")
-        suffix = file.path.suffix.lower()
+        suffix = utils.normalize_suffix_str(file.path.suffix)
         canonical_file_name = name + suffix
-        if canonical_file_name in name_counts:
-            ncount = name_counts[canonical_file_name]
-            name_counts[canonical_file_name] += 1
+        if canonical_file_name in self.name_counts:
+            ncount = self.name_counts[canonical_file_name]
+            self.name_counts[canonical_file_name] += 1
             canonical_file_name = name + f"-{ncount}" + suffix
         else:
-            name_counts[canonical_file_name] = 1
-        canonical_path = utils.normalize_suffix(archive / file.capture_time.strftime("%Y") / file.capture_time.strftime("%m") / canonical_file_name)
-        return ImportOperation(file.path, canonical_path)
-    
-    name_counts = dict()
-    return [make_operation(f, name_counts) for f in files]
-
-def perform_import(import_operations: Iterable[ImportOperation], move_files: bool, test_only: bool) -> None:
+            self.name_counts[canonical_file_name] = 1
+        return ImportOperation(file.path, folder, canonical_file_name)
+
+
+def make_import_operations(archive: pathlib.Path, files: Iterable[ImportFile]) -> Iterable[ImportOperation]:
+    planner = ImportPlanner(archive)
+    return [planner.plan(f) for f in files]
+
+def format_operation(move_files: bool, test_only: bool) -> str:
     operation = utils.emphasis_str("MOVE" if move_files else "COPY")
     if test_only:
         operation = utils.emphasis_str("TEST") + " " + operation
-    for op in import_operations:
-        click.echo(f"{operation} {op.original_path} {utils.emphasis_str("TO")} {op.canonical_path}...", nl=False)
-        if not test_only:
-            if not op.canonical_path.parent.exists():
-                op.canonical_path.parent.mkdir(parents=True)
-            shutil.copy2(op.original_path, op.canonical_path)
-            if move_files:
-                op.original_path.unlink()
-        click.echo(utils.emphasis_str("OK"))
+    return operation
+
+@instrumentation.instrumented("perform_import")
+def perform_import(import_operations: Iterable[ImportOperation],
+                   move_files: bool,
+                   test_only: bool,
+                   copy_jobs: int = transfer.DEFAULT_COPY_JOBS,
+                   progress: Progress | None = None,
+                   journal: ImportJournal | None = None,
+                   catalog: Catalog | None = None,
+                   verify: bool = False,
+                   index: ContentIndex | None = None,
+                   cache: MetadataCache | None = None) -> list[ImportOperation]:
+    """
+    Carry out import operations, adding the imported files to the catalog and content index where given,
+    and moving the cache entries of the imported files to their archive paths.
+    With verify, every copy is checked against the data read from the original, and the checksums are kept in the
+    content index. Files failing the check are reported, with their copies removed and their originals kept.
+    Returns the operations left undone because their target was taken meanwhile, e.g. by another import.
+    """
+    operation = format_operation(move_files, test_only)
+    action = "move" if move_files else "copy"
+    with transfer.TransferEngine(move_files, copy_jobs) as engine:
+        def execute(op: ImportOperation) -> TransferResult:
+            result = TransferResult(op, op.canonical_path)
+            if test_only:
+                return result
+            try:
+                if verify:
+                    result.checksum = engine.transfer_verified(op.original_path, result.canonical_path)
+                else:
+                    engine.transfer(op.original_path, result.canonical_path)
+            except (integrity.VerificationError, FileExistsError) as err:
+                result.error = err
+                return result
+            if journal is not None:
+                journal.completed(result.canonical_path)
+            result.size = result.canonical_path.stat().st_size
+            return result
+
+        imported = []
+        transferred = []
+        checksums = dict()
+        failed = 0
+        conflicts = []
+        for result in engine.map(execute, import_operations):
+            op = result.operation
+            line = f"{operation} {op.original_path} {utils.emphasis_str("TO")} {result.canonical_path}..."
+            if isinstance(result.error, FileExistsError):
+                reporting.warn(f"{line}{utils.warn_str("Already exists - the name was taken by another import meanwhile.")}")
+                reporting.record(action, "exists", src=op.original_path, dst=result.canonical_path)
+                conflicts.append(op)
+            elif result.error is not None:
+                reporting.warn(f"{line}{utils.error_str(str(result.error))}")
+                reporting.record(action, "error", src=op.original_path, dst=result.canonical_path, error=str(result.error))
+                failed += 1
+            else:
+                reporting.echo(f"{line}{utils.emphasis_str("OK")}")
+                reporting.record(action, "test" if test_only else "ok", src=op.original_path, dst=result.canonical_path, bytes=result.size, checksum=result.checksum)
+                if (catalog is not None or index is not None) and not test_only:
+                    imported.append(result.canonical_path)
+                if cache is not None and not test_only:
+                    transferred.append((op.original_path, result.canonical_path))
+                if result.checksum is not None:
+                    checksums[result.canonical_path] = result.checksum
+            if progress is not None:
+                progress.advance(op.original_path)
+        if engine.methods:
+            reporting.echo(engine.format_stats())
+    if transferred:
+        cache.relocate(transferred)
+    if imported and catalog is not None:
+        catalog.add_files(imported, cache=cache)
+    if imported and index is not None:
+        index.add(imported, checksums)
+    if failed:
+        reporting.warn(utils.error_str(f"{failed} files failed verification. Their copies were removed and the originals kept - import them again."))
+    if conflicts:
+        reporting.warn(utils.warn_str(f"{len(conflicts)} files weren't imported, as their names in the archive were taken meanwhile."))
+    return conflicts
+
+@contextlib.contextmanager
+def open_journal(archive: pathlib.Path, move_files: bool, test_only: bool) -> Iterator[ImportJournal | None]:
+    if test_only:
+        yield None
+        return
+    with ImportJournal(archive) as journal:
+        journal.begin(move_files)
+        yield journal
+        journal.end()
+
+def verify_partial_operation(original_path: pathlib.Path, canonical_path: pathlib.Path, size: int, move_files: bool) -> bool | None:
+    """
+    Check an operation of an interrupted import that wasn't recorded as completed.
+
+    Returns True if it's complete after all (removing the original when moving), False if it must be redone,
+    and None if it can't be completed because the original is gone.
+    """
+    if not canonical_path.exists():
+        return False if original_path.exists() else None
+    elif not original_path.exists():
+        # Renamed, or copied and then unlinked - unless the copy is incomplete
+        return True if canonical_path.stat().st_size == size else None
+    elif canonical_path.stat().st_size != original_path.stat().st_size or full_hash(canonical_path) != full_hash(original_path):
+        return False
+    else:
+        if move_files:
+            original_path.unlink()
+        return True
+
+def resume_import(archive: pathlib.Path, test_only: bool, copy_jobs: int, verify: bool = False) -> None:
+    runs = ImportJournal(archive).unfinished_runs()
+    if not runs:
+        reporting.echo("No interrupted import found - exiting.")
+        return
+
+    for run in runs:
+        pending = run.pending
+        reporting.echo(f"Resuming import: {len(run.completed)} files done, {len(pending)} left. Verifying unfinished files...")
+        with ImportJournal(archive) as journal:
+            if not test_only:
+                journal.begin(run.move_files, run.run_id)
+            import_operations = []
+            with reporting.stage("verify"):
+                for original_path, canonical_path, size in pending:
+                    state = verify_partial_operation(original_path, canonical_path, size, run.move_files and not test_only)
+                    if state is None:
+                        reporting.warn(utils.error_str(f"Original file '{original_path}' is missing and '{canonical_path}' is incomplete or missing."))
+                        reporting.record("verify", "missing", src=original_path, dst=canonical_path)
+                    elif state:
+                        reporting.echo(f"{utils.emphasis_str("VERIFIED")} {original_path} {utils.emphasis_str("TO")} {canonical_path}...{utils.emphasis_str("OK")}")
+                        reporting.record("verify", src=original_path, dst=canonical_path)
+                        if not test_only:
+                            journal.completed(canonical_path)
+                    else:
+                        if not test_only:
+                            # Incomplete copy made by the interrupted run - transfers never replace existing files
+                            canonical_path.unlink(missing_ok=True)
+                        import_operations.append(ImportOperation(original_path, canonical_path.parent, canonical_path.name))
+
+            reporting.echo("Importing files...")
+            with reporting.stage("transfer"):
+                with (open_catalog(archive) as catalog, open_index(archive, verify and not test_only) as index,
+                      open_cache(archive, False, False) as cache):
+                    perform_import(import_operations, run.move_files, test_only, copy_jobs, journal=None if test_only else journal,
+                                   catalog=catalog, verify=verify, index=index, cache=cache)
+            if not test_only:
+                journal.end()
+    reporting.echo("Done.")
+
+def stream_import(archive: pathlib.Path,
+                  import_items: Iterable[pathlib.Path],
+                  move_files: bool,
+                  files_only: bool,
+                  recursive_search: bool,
+                  test_only: bool,
+                  no_cache: bool,
+                  rebuild_cache: bool,
+                  jobs: int,
+                  processes: bool,
+                  copy_jobs: int,
+                  skip_duplicates: bool,
+                  verify: bool = False) -> None:
+    """
+    Import files as they are found: discovery, metadata extraction and planning run ahead on background threads,
+    connected by bounded queues, while files are copied. Planning happens in discovery order, so file names come
+    out the same as with make_import_operations.
+    """
+    file_stats: dict[pathlib.Path, os.stat_result] = dict()
+    warnings = []
+    skipped = []
+    counts = {"found": 0, "planned": 0}
+    cache_stats = []
+
+    def discover() -> Iterable[pathlib.Path]:
+        for file, stat in utils.collect_image_file_stats(import_items, files_only, recursive_search, utils.IMAGE_EXTS, jobs):
+            counts["found"] += 1
+            file_stats[file] = stat
+            yield file
+
+    def plan() -> Iterable[ImportOperation]:
+        planner = ImportPlanner(archive)
+        discovered = concurrency.background(discover(), STREAM_QUEUE_SIZE)
+        with open_cache(archive, no_cache, rebuild_cache) as cache, open_index(archive, skip_duplicates) as index:
+            if index is not None:
+                index.refresh()
+            for result in extraction.extract_metadata(discovered, ["datetime_original"], cache, jobs, processes, file_stats):
+                warnings.extend(result.warnings)
+                capture_time = parse_datetime(result.tags["datetime_original"] if result.tags else None)
+                if capture_time is None:
+                    file_stats.pop(result.path, None)
+                    warnings.append(utils.warn_str(f"No capture time on file '{result.path}' - skipping."))
+                    reporting.record("skip", path=result.path, reason="no capture time")
+                    continue
+                # Looked up only now, so files dropped for lack of a capture time aren't taken for imported ones
+                if index is not None and (duplicate := index.find_duplicate(result.path, file_stats[result.path])) is not None:
+                    file_stats.pop(result.path, None)
+                    skipped.append(f"{utils.emphasis_str("SKIP")} {result.path}: already in archive as '{duplicate}'.")
+                    reporting.record("skip", path=result.path, duplicate=duplicate)
+                    continue
+                counts["planned"] += 1
+                yield planner.plan(ImportFile(result.path, capture_time))
+            if cache is not None:
+                cache_stats.append(cache.format_stats())
+
+    def journaled(import_operations: Iterable[ImportOperation], journal: ImportJournal | None) -> Iterable[ImportOperation]:
+        for op in import_operations:
+            if journal is not None:
+                journal.planned(op.original_path, op.canonical_path, file_stats[op.original_path].st_size)
+            yield op
+
+    progress = Progress("Imported", lambda: f"{counts["found"]} found, {counts["planned"]} planned",
+                        size=lambda file: stat.st_size if (stat := file_stats.pop(file, None)) is not None else 0)
+    with (open_journal(archive, move_files, test_only) as journal, open_catalog(archive) as catalog,
+          open_index(archive, verify and not test_only) as index, open_cache(archive, no_cache, False) as cache,
+          reporting.stage("import")):
+        import_operations = journaled(concurrency.background(plan(), STREAM_QUEUE_SIZE), journal)
+        perform_import(import_operations, move_files, test_only, copy_jobs, progress, journal, catalog, verify, index, cache)
+    progress.finish()
+    reporting.count("found", counts["found"])
+
+    for message in skipped:
+        reporting.echo(message)
+    for warning in warnings:
+        reporting.warn(warning)
+    for stats in cache_stats:
+        reporting.echo(stats)
 
 def import_files(archive: pathlib.Path,
                  import_items: Iterable[pathlib.Path],
                  move_files: bool,
                  files_only: bool,
                  recursive_search: bool,
-                 test_only: bool) -> None:
+                 test_only: bool,
+                 no_cache: bool = False,
+                 rebuild_cache: bool = False,
+                 jobs: int = concurrency.DEFAULT_JOBS,
+                 processes: bool = False,
+                 stream: bool = False,
+                 copy_jobs: int = transfer.DEFAULT_COPY_JOBS,
+                 skip_duplicates: bool = False,
+                 resume: bool = False,
+                 verify: bool = False) -> None:
+    if resume:
+        resume_import(archive, test_only, copy_jobs, verify)
+        return
+    if archive.exists() and ImportJournal(archive).unfinished_runs():
+        reporting.warn(utils.error_str("An earlier import into this archive was interrupted. Complete it with --resume first. Exiting."))
+        return
+
     if not archive.exists():
-        click.echo(f"{utils.emphasis_str("NOTE")}: Archive directory doesn't exist. Creating directory '{archive.absolute()}'.")
+        reporting.echo(f"{utils.emphasis_str("NOTE")}: Archive directory doesn't exist. Creating directory '{archive.absolute()}'.")
         if not test_only:
             archive.mkdir(parents=True)
-    
-    click.echo("Collecting files... ", nl=False)
-    image_files = list(utils.collect_image_files(import_items, files_only, recursive_search, utils.IMAGE_EXTS))
-    click.echo(f"found {len(image_files)}.")
+
+    if stream:
+        reporting.echo("Importing files as they are found...")
+        stream_import(archive, import_items, move_files, files_only, recursive_search, test_only, no_cache, rebuild_cache, jobs, processes, copy_jobs, skip_duplicates, verify)
+        reporting.echo("Done.")
+        return
+
+    reporting.echo("Collecting files... ", nl=False)
+    with reporting.stage("collect"):
+        file_stats = dict(utils.collect_image_file_stats(import_items, files_only, recursive_search, utils.IMAGE_EXTS, jobs))
+    image_files = list(file_stats)
+    reporting.echo(f"found {len(image_files)}.")
+    reporting.count("found", len(image_files))
 
     if len(image_files) == 0:
-        click.echo("No files found - exiting.")
+        reporting.echo("No files found - exiting.")
         return
 
-    click.echo("Processing image files...")
-    import_files = process_input_files(image_files)
+    reporting.echo("Processing image files...")
+    with open_cache(archive, no_cache, rebuild_cache) as cache, reporting.stage("metadata"):
+        import_files = process_input_files(image_files, cache, jobs, processes, file_stats)
+        if cache is not None:
+            reporting.echo(cache.format_stats())
+
+    if skip_duplicates:
+        # After reading capture times, so only files that are planned next are remembered as about to be imported
+        with open_index(archive, skip_duplicates) as index, reporting.stage("dedupe"):
+            if index is not None:
+                reporting.echo("Updating archive content index... ", nl=False)
+                reporting.echo(f"{index.refresh()} new or changed files.")
+                reporting.echo("Skipping files already in the archive...")
+                import_files = list(filter_duplicates(import_files, file_stats, index))
+                reporting.echo(f"{len(import_files)} files left to import, {index.computed_hashes} hashes computed.")
+        if len(import_files) == 0:
+            reporting.echo("Nothing new to import - exiting.")
+            return
 
-    click.echo("Planning import operation...")
-    import_operations = make_import_operations(archive, import_files)
+    reporting.echo("Planning import operation...")
+    with reporting.stage("plan"):
+        import_operations = make_import_operations(archive, import_files)
 
-    click.echo("Importing files...")
-    perform_import(import_operations, move_files, test_only)
+    reporting.echo("Importing files...")
+    with (open_journal(archive, move_files, test_only) as journal, open_catalog(archive) as catalog,
+          open_index(archive, verify and not test_only) as index, open_cache(archive, no_cache, False) as cache,
+          reporting.stage("transfer")):
+        if journal is not None:
+            journal.planned_all((op.original_path, op.canonical_path, file_stats[op.original_path].st_size) for op in import_operations)
+        perform_import(import_operations, move_files, test_only, copy_jobs, journal=journal, catalog=catalog, verify=verify, index=index, cache=cache)
 
-    click.echo("Done.")
+    reporting.echo("Done.")
@@ -0,0 +1,138 @@
+import contextlib, functools, json, os, pathlib, sys, threading, time
+
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Callable, Iterator, TypeVar
+
+F = TypeVar("F", bound=Callable)
+
+PROFILE_MODES = ["summary", "cprofile", "trace"]
+DEFAULT_PROFILE_FILES = {"cprofile": "archivist.pstats", "trace": "archivist-trace.json"}
+
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    category: str
+    thread: int
+    start_ns: int
+    duration_ns: int
+
+
+class Profiler:
+    """
+    Timed spans and counters of a run, for --profile. Stages of the commands and hot functions are recorded
+    as spans on whichever thread they run, which is lost for work done in worker processes. Only a trace keeps
+    every span - otherwise they're added up by name as they end, so memory use doesn't grow with the run.
+    """
+
+    def __init__(self, mode: str = "summary", out_file: pathlib.Path | None = None):
+        self.mode = mode
+        self.out_file = out_file or pathlib.Path(DEFAULT_PROFILE_FILES.get(mode, ""))
+        self.spans: list[Span] = []
+        # (category, name) -> [calls, total ns]
+        self.totals: dict[tuple[str, str], list[int]] = defaultdict(lambda: [0, 0])
+        self.counters: Counter = Counter()
+        self.threads: dict[int, str] = dict()
+        self.started_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._cprofile = None
+        if mode == "cprofile":
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "function") -> Iterator[None]:
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration_ns = time.perf_counter_ns() - start_ns
+            if self.mode == "trace":
+                thread = threading.get_ident()
+                if thread not in self.threads:
+                    self.threads[thread] = threading.current_thread().name
+                # list.append is atomic, so this needs no lock
+                self.spans.append(Span(name, category, thread, start_ns, duration_ns))
+            else:
+                with self._lock:
+                    total = self.totals[category, name]
+                    total[0] += 1
+                    total[1] += duration_ns
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def finish(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.out_file)
+            echo_stderr(f"Wrote cProfile stats to '{self.out_file}' (main thread only) - view them with python -m pstats.")
+        elif self.mode == "trace":
+            self.write_trace()
+            echo_stderr(f"Wrote trace of {len(self.spans)} spans to '{self.out_file}' - open it in Perfetto or chrome://tracing.")
+        else:
+            echo_stderr(self.format_summary())
+
+    def format_summary(self) -> str:
+        elapsed = (time.perf_counter_ns() - self.started_ns) / 1e9
+        lines = [f"Profile of {elapsed:.3f}s run - times of functions running on several threads add up:",
+                 f"  {"":<28}{"calls":>9}{"total":>11}{"mean":>11}"]
+        for category in ("stage", "function"):
+            rows = sorted(((name, calls, ns) for (c, name), (calls, ns) in self.totals.items() if c == category), key=lambda row: -row[2])
+            if rows:
+                lines.append(f"{category.capitalize()}s:")
+                lines.extend(f"  {name:<28}{calls:>9}{ns / 1e9:>10.3f}s{ns / calls / 1e6:>9.3f}ms" for name, calls, ns in rows)
+        if self.counters:
+            lines.append("Counters:")
+            lines.extend(f"  {name:<28}{count:>9}" for name, count in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+    def write_trace(self):
+        """Write the spans in the Chrome trace event format, with the counters at the end of the run."""
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": name}} for thread, name in self.threads.items()]
+        events.extend({"name": span.name, "cat": span.category, "ph": "X", "pid": pid, "tid": span.thread,
+                       "ts": (span.start_ns - self.started_ns) / 1000, "dur": span.duration_ns / 1000} for span in self.spans)
+        if self.counters:
+            events.append({"name": "counters", "ph": "C", "pid": pid, "ts": (time.perf_counter_ns() - self.started_ns) / 1000, "args": dict(self.counters)})
+        with self.out_file.open("w") as fo:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fo)
+
+
+def echo_stderr(message: str):
+    # Always on stderr, so it doesn't get mixed into JSON output
+    print(message, file=sys.stderr)
+
+
+_profiler: Profiler | None = None
+_NO_SPAN = contextlib.nullcontext()
+
+def enable(mode: str = "summary", out_file: pathlib.Path | None = None) -> Profiler:
+    global _profiler
+    _profiler = Profiler(mode, out_file)
+    return _profiler
+
+def enabled() -> bool:
+    return _profiler is not None
+
+def span(name: str, category: str = "function") -> contextlib.AbstractContextManager[None]:
+    return _NO_SPAN if _profiler is None else _profiler.span(name, category)
+
+def add(name: str, n: int = 1):
+    if _profiler is not None:
+        _profiler.add(name, n)
+
+def instrumented(name: str) -> Callable[[F], F]:
+    """Record every call of the decorated function as a span. Costs a single check per call while not profiling."""
+    def decorate(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,79 @@
+import hashlib, os, pathlib, shutil, threading, time
+
+from . import instrumentation
+from .transfer import CHUNK_SIZE
+
+
+class VerificationError(OSError):
+    pass
+
+
+class RateLimiter:
+    """Caps the combined read rate of all threads sharing it, by having each read wait for its turn."""
+
+    def __init__(self, bytes_per_second: float | None = None):
+        self.bytes_per_second = bytes_per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int):
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + n / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+_buffers = threading.local()
+
+def copy_buffer() -> memoryview:
+    """A large buffer per thread, reused across files, as allocating one per file costs more than reading a small file."""
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _buffers.buffer = memoryview(bytearray(CHUNK_SIZE))
+    return buffer
+
+def drop_cached_pages(fd: int):
+    """Have the kernel forget the cached contents of a file, so reading it goes to the disk (where supported)."""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+@instrumentation.instrumented("hash_file")
+def hash_file(file: pathlib.Path, limiter: RateLimiter | None = None) -> str:
+    """Hash of the contents of a file as stored on disk - the same as content_index.full_hash."""
+    digest = hashlib.blake2b()
+    buffer = copy_buffer()
+    with file.open("rb", buffering=0) as fo:
+        drop_cached_pages(fo.fileno())
+        while n := fo.readinto(buffer):
+            digest.update(buffer[:n])
+            if limiter is not None:
+                limiter.consume(n)
+        instrumentation.add("hash_bytes_read", fo.tell())
+    return digest.hexdigest()
+
+@instrumentation.instrumented("copy_file_hashed")
+def copy_file_hashed(src: pathlib.Path, dst: pathlib.Path) -> str:
+    """
+    Copy data and metadata like transfer.copy_file, hashing the data as it passes through the copy buffer,
+    so the source is only read once. The copy is synced to disk before the hash is returned.
+    """
+    digest = hashlib.blake2b()
+    buffer = copy_buffer()
+    with src.open("rb", buffering=0) as fsrc, dst.open("xb", buffering=0) as fdst:
+        while n := fsrc.readinto(buffer):
+            chunk = buffer[:n]
+            digest.update(chunk)
+            while chunk:
+                chunk = chunk[fdst.write(chunk):]
+        os.fsync(fdst.fileno())
+        instrumentation.add("bytes_copied", fdst.tell())
+    shutil.copystat(src, dst)
+    return digest.hexdigest()
+
+def verify_file(file: pathlib.Path, expected_hash: str):
+    if hash_file(file) != expected_hash:
+        raise VerificationError(f"Contents of '{file}' differ from what was written")
@@ -0,0 +1,110 @@
+import datetime, json, os, pathlib, threading, uuid
+
+from dataclasses import dataclass, field
+from typing import Iterable
+
+JOURNAL_FILE_NAME = ".archivist-journal.ndjson"
+
+
+@dataclass
+class JournalRun:
+    run_id: str
+    move_files: bool
+    planned: list[tuple[pathlib.Path, pathlib.Path, int]] = field(default_factory=list)
+    completed: set[pathlib.Path] = field(default_factory=set)
+    ended: bool = False
+
+    @property
+    def pending(self) -> list[tuple[pathlib.Path, pathlib.Path, int]]:
+        """(original path, canonical path, size) of every planned operation not recorded as completed."""
+        return [p for p in self.planned if p[1] not in self.completed]
+
+
+class ImportJournal:
+    """
+    Append-only log of planned and completed import operations, kept in the archive.
+
+    Each line is a JSON record. An import run writes a "begin" record, one "plan" record per operation
+    before it's carried out, a "done" record once it's complete, and an "end" record when the run finishes.
+    """
+
+    def __init__(self, archive: pathlib.Path):
+        self.journal_file = archive / JOURNAL_FILE_NAME
+        self.run_id: str | None = None
+        self._fo = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._fo is not None:
+            self._fo.close()
+            self._fo = None
+
+    def read_runs(self) -> list[JournalRun]:
+        runs: dict[str, JournalRun] = dict()
+        if not self.journal_file.exists():
+            return []
+        with self.journal_file.open("r", encoding="utf-8") as fo:
+            for line in fo:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line from a crash while writing
+                    continue
+                event = record.get("event")
+                if event == "begin":
+                    runs[record["run"]] = JournalRun(record["run"], record["move"])
+                elif record.get("run") not in runs:
+                    continue
+                elif event == "plan":
+                    runs[record["run"]].planned.append((pathlib.Path(record["src"]), pathlib.Path(record["dst"]), record["size"]))
+                elif event == "done":
+                    runs[record["run"]].completed.add(pathlib.Path(record["dst"]))
+                elif event == "end":
+                    runs[record["run"]].ended = True
+        return list(runs.values())
+
+    def unfinished_runs(self) -> list[JournalRun]:
+        return [run for run in self.read_runs() if not run.ended]
+
+    def begin(self, move_files: bool, run_id: str | None = None):
+        """Start a new run, or continue the given one. The journal is emptied when no earlier run is unfinished."""
+        if run_id is None and not self.unfinished_runs():
+            self.journal_file.unlink(missing_ok=True)
+        self.run_id = run_id if run_id is not None else uuid.uuid4().hex
+        self._fo = self.journal_file.open("a", encoding="utf-8")
+        if run_id is None:
+            self._write({"event": "begin", "move": move_files, "time": datetime.datetime.now().isoformat()}, sync=True)
+
+    def planned(self, original_path: pathlib.Path, canonical_path: pathlib.Path, size: int):
+        self._write({"event": "plan", "src": str(original_path.absolute()), "dst": str(canonical_path.absolute()), "size": size})
+
+    def planned_all(self, operations: Iterable[tuple[pathlib.Path, pathlib.Path, int]]):
+        for original_path, canonical_path, size in operations:
+            self.planned(original_path, canonical_path, size)
+        self._sync()
+
+    def completed(self, canonical_path: pathlib.Path):
+        self._write({"event": "done", "dst": str(canonical_path.absolute())})
+
+    def end(self):
+        self._write({"event": "end"}, sync=True)
+
+    def _write(self, record: dict, sync: bool = False):
+        record["run"] = self.run_id
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._fo.write(line)
+            self._fo.flush()
+            if sync:
+                os.fsync(self._fo.fileno())
+
+    def _sync(self):
+        with self._lock:
+            self._fo.flush()
+            os.fsync(self._fo.fileno())
@@ -0,0 +1,172 @@
+import pathlib
+import struct
+
+from typing import Any, BinaryIO, Iterable
+
+from . import instrumentation
+
+# EXIF tag IDs, named the same way as the attributes of the exif library
+TAG_IDS = {
+    "make": 0x010F,
+    "model": 0x0110,
+    "datetime": 0x0132,
+    "exposure_time": 0x829A,
+    "f_number": 0x829D,
+    "photographic_sensitivity": 0x8827,
+    "datetime_original": 0x9003,
+    "datetime_digitized": 0x9004,
+    "focal_length": 0x920A,
+    "focal_length_in_35mm_film": 0xA405,
+    "lens_make": 0xA433,
+    "lens_model": 0xA434,
+}
+# Tags commonly needed by the commands - reading all of them costs the same as reading one
+METADATA_TAGS = ("datetime_original", "focal_length_in_35mm_film", "make", "model", "lens_model", "f_number", "photographic_sensitivity")
+
+EXIF_IFD_POINTER = 0x8769
+# TIFF magic numbers: standard TIFF, Olympus ORF ("RO", "RS") and Panasonic RW2 ("U\0")
+TIFF_MAGICS = {42, 0x4F52, 0x5352, 0x55}
+RAF_MAGIC = b"FUJIFILMCCD-RAW"
+# (size in bytes, struct format) per TIFF field type
+FIELD_TYPES = {
+    1: (1, "B"),   # BYTE
+    2: (1, "s"),   # ASCII
+    3: (2, "H"),   # SHORT
+    4: (4, "I"),   # LONG
+    5: (8, "II"),  # RATIONAL
+    6: (1, "b"),   # SBYTE
+    7: (1, "s"),   # UNDEFINED
+    8: (2, "h"),   # SSHORT
+    9: (4, "i"),   # SLONG
+    10: (8, "ii"), # SRATIONAL
+}
+
+READ_WINDOW = 64 * 1024
+MAX_IFD_ENTRIES = 1024
+MAX_VALUE_SIZE = 64 * 1024
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+class WindowReader:
+    """Random access to a file through a single bounded read window."""
+
+    def __init__(self, fo: BinaryIO, window: int = READ_WINDOW):
+        self._fo = fo
+        self._window = window
+        self._start = 0
+        self._data = b""
+
+    def read(self, offset: int, size: int) -> bytes:
+        if offset < 0 or size < 0:
+            raise ValueError(f"Invalid read of {size} bytes at offset {offset}")
+        end = offset + size
+        if offset < self._start or end > self._start + len(self._data):
+            self._fo.seek(offset)
+            self._data = self._fo.read(max(size, self._window))
+            self._start = offset
+            instrumentation.add("exif_bytes_read", len(self._data))
+        data = self._data[offset - self._start:end - self._start]
+        if len(data) != size:
+            raise ValueError(f"Unexpected end of file reading {size} bytes at offset {offset}")
+        return data
+
+
+def decode_value(field_type: int, count: int, data: bytes, endian: str) -> Any:
+    if field_type == 2:
+        return data.split(b"\x00", 1)[0].decode("ascii", errors="replace")
+    if field_type in (1, 7) and count != 1:
+        return data
+    size, fmt = FIELD_TYPES[field_type]
+    values = struct.unpack(endian + fmt * count, data)
+    if field_type in (5, 10):
+        # Same convention as the exif library: 0/0 means "unknown" and is reported as 0. Any other n/0 is malformed.
+        values = tuple(0 if n == 0 else None if d == 0 else n / d for n, d in zip(values[::2], values[1::2]))
+    return values[0] if len(values) == 1 else values
+
+def read_ifd(reader: WindowReader, base: int, offset: int, endian: str, wanted: dict[int, str], values: dict[str, Any]) -> int | None:
+    """Decode all wanted tags from the IFD at the given offset. Returns the Exif IFD offset, if present."""
+    (count,) = struct.unpack(endian + "H", reader.read(base + offset, 2))
+    if count > MAX_IFD_ENTRIES:
+        raise ValueError(f"Implausible IFD entry count {count}")
+    entries = reader.read(base + offset + 2, count * 12)
+    exif_ifd_offset = None
+    for i in range(count):
+        tag_id, field_type, value_count, raw_value = struct.unpack_from(endian + "HHI4s", entries, i * 12)
+        if tag_id == EXIF_IFD_POINTER:
+            (exif_ifd_offset,) = struct.unpack(endian + "I", raw_value)
+            continue
+        name = wanted.get(tag_id)
+        if name is None or name in values or field_type not in FIELD_TYPES:
+            continue
+        size = FIELD_TYPES[field_type][0] * value_count
+        if size > MAX_VALUE_SIZE:
+            continue
+        if size <= 4:
+            data = raw_value[:size]
+        else:
+            (value_offset,) = struct.unpack(endian + "I", raw_value)
+            data = reader.read(base + value_offset, size)
+        values[name] = decode_value(field_type, value_count, data, endian)
+    return exif_ifd_offset
+
+def read_tiff_tags(reader: WindowReader, base: int, tags: Iterable[str]) -> dict[str, Any]:
+    header = reader.read(base, 8)
+    if header[:2] == b"II":
+        endian = "<"
+    elif header[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Invalid TIFF byte order")
+    magic, ifd0_offset = struct.unpack(endian + "HI", header[2:])
+    if magic not in TIFF_MAGICS:
+        raise ValueError(f"Invalid TIFF magic number {magic}")
+
+    wanted = {TAG_IDS[tag]: tag for tag in tags}
+    values = {}
+    exif_ifd_offset = read_ifd(reader, base, ifd0_offset, endian, wanted, values)
+    if exif_ifd_offset and len(values) < len(wanted):
+        read_ifd(reader, base, exif_ifd_offset, endian, wanted, values)
+    return {tag: values.get(tag) for tag in wanted.values()}
+
+def read_jpeg_tags(reader: WindowReader, start: int, tags: Iterable[str]) -> dict[str, Any] | None:
+    """Walk the JPEG segment headers up to the image data, looking for the EXIF APP1 segment."""
+    offset = start + 2 # Skip SOI marker
+    while True:
+        marker = reader.read(offset, 2)
+        if marker[0] != 0xFF:
+            raise ValueError(f"Invalid JPEG marker at offset {offset}")
+        if marker[1] == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker[1] in (0xD9, 0xDA):
+            # EOI or SOS - no metadata beyond this point
+            return None
+        (length,) = struct.unpack(">H", reader.read(offset + 2, 2))
+        if marker[1] == 0xE1 and reader.read(offset + 4, 6) == b"Exif\x00\x00":
+            return read_tiff_tags(reader, offset + 10, tags)
+        offset += 2 + length
+
+def read_tags(file: pathlib.Path, tags: Iterable[str] = METADATA_TAGS) -> dict[str, Any] | None:
+    """
+    Read EXIF tags from the header region of a JPEG, TIFF-based RAW or RAF file, without reading the image data.
+
+    Returns a dict with an entry for each requested tag (None if missing), or None if the file has no EXIF data.
+    Raises UnsupportedFormat for files that can't be handled here, and ValueError for malformed headers.
+    """
+    with file.open("rb") as fo:
+        reader = WindowReader(fo)
+        head = fo.read(16)
+        if head[:2] == b"\xff\xd8":
+            return read_jpeg_tags(reader, 0, tags)
+        elif head.startswith(RAF_MAGIC):
+            # RAF embeds a JPEG preview (with full EXIF data) at an offset given in its header
+            jpeg_offset, _ = struct.unpack(">II", reader.read(84, 8))
+            return read_jpeg_tags(reader, jpeg_offset, tags)
+        elif head[:2] in (b"II", b"MM"):
+            return read_tiff_tags(reader, 0, tags)
+        else:
+            raise UnsupportedFormat(f"Unsupported file format for '{file}'")
@@ -0,0 +1,96 @@
+import contextlib, json, os, pathlib
+
+from typing import Any, Iterable
+
+from . import instrumentation, metadata
+
+CACHE_FILE_NAME = ".archivist-cache.sqlite3"
+COMMIT_INTERVAL = 1000
+
+
+class MetadataCache:
+    """Persistent cache of parsed EXIF tags, keyed by file path, size and modification time."""
+
+    MISS = object()
+
+    def __init__(self, cache_file: pathlib.Path, rebuild: bool = False):
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        import sqlite3 # Only needed once a cache is opened - this module is imported by every command
+        self._connection = sqlite3.connect(cache_file)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, tags TEXT)")
+        if rebuild:
+            self._connection.execute("DELETE FROM metadata")
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def get(self, file: pathlib.Path, stat: os.stat_result, tags: Iterable[str]) -> dict[str, Any] | None | object:
+        """Return the cached tags of the file (None if it has no EXIF data), or MISS if the cache can't answer."""
+        row = self._connection.execute("SELECT size, mtime_ns, tags FROM metadata WHERE path = ?", (str(file.absolute()),)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            values = json.loads(row[2])
+            if values is None:
+                self.hits += 1
+                instrumentation.add("cache_hits")
+                return None
+            if all(tag in values for tag in tags):
+                self.hits += 1
+                instrumentation.add("cache_hits")
+                return {tag: values[tag] for tag in tags}
+        self.misses += 1
+        instrumentation.add("cache_misses")
+        return self.MISS
+
+    def put(self, file: pathlib.Path, stat: os.stat_result, values: dict[str, Any] | None):
+        self._connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                                 (str(file.absolute()), stat.st_size, stat.st_mtime_ns, json.dumps(values, default=str)))
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self._connection.commit()
+            self._pending = 0
+
+    def relocate(self, transfers: Iterable[tuple[pathlib.Path, pathlib.Path]]):
+        """
+        Move the entries of files imported into an archive to their archive paths, rather than leaving them behind
+        under inbox paths that won't be looked up again. Copies keep size and modification time, so this holds for them, too.
+        """
+        self._connection.executemany("UPDATE OR REPLACE metadata SET path = ? WHERE path = ?",
+                                     ((str(target.absolute()), str(source.absolute())) for source, target in transfers))
+        self._connection.commit()
+        self._pending = 0
+
+    def format_stats(self) -> str:
+        return f"Metadata cache: {self.hits} hits, {self.misses} misses."
+
+    @staticmethod
+    def tags_to_read(tags: Iterable[str]) -> tuple[str, ...]:
+        """On a miss, read every commonly used tag, so the cache can answer for the other commands, too."""
+        return tuple(dict.fromkeys((*metadata.METADATA_TAGS, *tags)))
+
+
+def find_cache_root(paths: Iterable[pathlib.Path]) -> pathlib.Path | None:
+    """The archive with an existing cache that all the given paths are in, if there is one."""
+    roots = set()
+    for path in paths:
+        path = path.absolute()
+        roots.add(next((folder for folder in [path, *path.parents] if (folder / CACHE_FILE_NAME).is_file()), None))
+    return roots.pop() if len(roots) == 1 else None
+
+def open_cache(root: pathlib.Path | None, no_cache: bool, rebuild: bool) -> contextlib.AbstractContextManager[MetadataCache | None]:
+    if no_cache or root is None or not root.is_dir():
+        return contextlib.nullcontext(None)
+    else:
+        return MetadataCache(root / CACHE_FILE_NAME, rebuild)
@@ -1,46 +1,165 @@
-import pathlib
-import click
+import os, pathlib
 
-from itertools import groupby
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
 from typing import Iterable
 
-from . import utils
+from . import concurrency, reporting, utils
+from .catalog import covering_catalogs
 
-def normalize(paths: Iterable[pathlib.Path], recurse: bool, test_only: bool):
+TEMP_NAME = ".{}.archivist-rename"
+
+
+@dataclass(slots=True)
+class Rename:
+    source: pathlib.Path
+    target: pathlib.Path
+    skipped: bool = False
+
+    @property
+    def case_only(self) -> bool:
+        return self.source.name.casefold() == self.target.name.casefold()
+
+
+@dataclass
+class FolderRenames:
+    folder: pathlib.Path
+    renames: list[Rename]
+    failures: dict[pathlib.Path, OSError] = field(default_factory=dict)
+
+
+def is_normalizable(name: str) -> bool:
+    suffix = os.path.splitext(name)[1]
+    return suffix.lower() != suffix or suffix.lower() in utils.FILE_EXT_NORMALIZATIONS
+
+def list_image_names(paths: Iterable[pathlib.Path], recurse: bool, jobs: int = 1) -> tuple[dict[pathlib.Path, list[str]], dict[pathlib.Path, set[str] | None]]:
+    """
+    Collect the image file names of every folder involved, listing each folder once, and which of them
+    were asked to be normalized - None meaning all of them, as for folders given or walked into.
+    """
+    paths = list(paths)
+    names: dict[pathlib.Path, list[str]] = defaultdict(list)
+    selected: dict[pathlib.Path, set[str] | None] = dict()
+    for file in utils.collect_image_files([p for p in paths if p.is_dir()], recurse=recurse, jobs=jobs):
+        names[file.parent].append(file.name)
+        selected[file.parent] = None
+    for file in utils.collect_image_files([p for p in paths if not p.is_dir()], files_only=True):
+        folder = file.parent
+        if folder not in names:
+            # Given as a file - the rest of its folder is needed to tell whether the new name is taken
+            names[folder] = [entry.name for entry, is_dir in utils.scan_directory(str(folder))
+                             if not is_dir and utils.has_accepted_suffix(entry.name, utils.IMAGE_EXTS)]
+            selected[folder] = set()
+        if selected[folder] is not None:
+            selected[folder].add(file.name)
+    return names, selected
+
+def plan_renames(folder: pathlib.Path, names: Iterable[str], selected: set[str] | None = None) -> list[Rename]:
+    """
+    Work out the new names of a folder's files in memory. A file is skipped if its new name is taken,
+    also by a name differing only in case, which is the same file name on case-insensitive filesystems.
+    """
+    names = sorted(names)
+    taken = Counter(name.casefold() for name in names)
+    renames = []
+    for name in names:
+        if not is_normalizable(name) or (selected is not None and name not in selected):
+            continue
+        rename = Rename(folder / name, utils.normalize_suffix(folder / name))
+        target_key = rename.target.name.casefold()
+        if taken[target_key] - (1 if rename.case_only else 0) > 0:
+            rename.skipped = True
+        else:
+            taken[name.casefold()] -= 1
+            taken[target_key] += 1
+        renames.append(rename)
+    return renames
+
+def rename_files(folder: pathlib.Path, renames: Iterable[Rename]) -> dict[pathlib.Path, OSError]:
+    """
+    Rename files of one folder relative to a single handle on it. Case-only renames go through a temporary name,
+    as renaming a file to its own name in different case is a no-op or an error on case-insensitive filesystems.
+    Returns the files that couldn't be renamed.
+    """
+    renames = [r for r in renames if not r.skipped]
+    failures = dict()
+    dir_fd = None
+    try:
+        if os.rename in os.supports_dir_fd:
+            dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+        def path(name: str) -> str | pathlib.Path:
+            return name if dir_fd is not None else folder / name
+        def move(source: str, target: str):
+            os.rename(path(source), path(target), src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+        for rename in renames:
+            source, target = rename.source.name, rename.target.name
+            try:
+                if not rename.case_only:
+                    move(source, target)
+                    continue
+                temp = TEMP_NAME.format(target)
+                move(source, temp)
+                try:
+                    move(temp, target)
+                except OSError:
+                    move(temp, source)
+                    raise
+            except OSError as err:
+                failures[rename.source] = err
+    except OSError as err:
+        failures = {rename.source: err for rename in renames}
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    return failures
+
+def normalize_folder(folder: pathlib.Path, names: list[str], selected: set[str] | None, test_only: bool) -> FolderRenames:
+    renames = plan_renames(folder, names, selected)
+    failures = dict() if test_only else rename_files(folder, renames)
+    return FolderRenames(folder, renames, failures)
+
+def normalize(paths: Iterable[pathlib.Path], recurse: bool, test_only: bool, jobs: int = concurrency.DEFAULT_JOBS):
     # Find files with non-conforming extensions
-    click.echo("Collecting image files... ", nl=False)
-    image_files = utils.collect_image_files(paths, recurse=recurse)
-    normalizable_images = list(filter(lambda p: p.suffix.lower() != p.suffix or p.suffix.lower() in utils.FILE_EXT_NORMALIZATIONS, image_files))
-    click.echo(f"found {len(normalizable_images)} normalizable files.")
+    reporting.echo("Collecting image files... ", nl=False)
+    with reporting.stage("collect"):
+        names, selected = list_image_names(paths, recurse, jobs)
+        folders = sorted(folder for folder, folder_names in names.items()
+                         if any(is_normalizable(name) and (selected[folder] is None or name in selected[folder]) for name in folder_names))
+    reporting.echo(f"found {len(folders)} folders with normalizable files.")
 
-    if len(normalizable_images) == 0:
-        click.echo("No files found. Exiting.")
+    if len(folders) == 0:
+        reporting.echo("No files found. Exiting.")
         return
 
-    # Group by folder
-    sorted_normalizable_images = sorted(normalizable_images)
-    folder_groups = groupby(sorted_normalizable_images, key=lambda p: p.parent)
-    
-    # Process files folder by folder
-    for current_folder, current_files in folder_groups:
-        current_files = list(current_files)
-        click.echo(f"Processing {len(current_files)} in '{current_folder}':")
-        for file in current_files:
-            click.echo("  ", nl=False)
-            if test_only:
-                click.echo(utils.emphasis_str("TEST "), nl=False)
-            normalized_file = utils.normalize_suffix(file)
-            click.echo(f"{file.name} -> {normalized_file.name} ", nl=False)
-            if normalized_file.exists():
-                # TODO: Fails here on Windows if suffix differs in upper/lowercase
-                click.echo(f"{utils.emphasis_str("SKIPPED")}: Already exists.")
-                continue
-            else:
-                try:
-                    if not test_only:
-                        file.rename(normalized_file)
-                    click.echo(utils.emphasis_str("OK"))
-                except OSError as err:
-                    click.echo(utils.error_str(str(err)))
-                    click.echo("Exiting.")
-                    return
+    # Plan and rename folder by folder, several folders at a time
+    test = utils.emphasis_str("TEST ") if test_only else ""
+    status = "test" if test_only else "ok"
+    renamed = skipped = failed = 0
+    with concurrency.make_executor(jobs) as executor, covering_catalogs() as catalog_for, reporting.stage("rename"):
+        results = concurrency.ordered_map(executor, lambda folder: normalize_folder(folder, names[folder], selected[folder], test_only), folders, window=jobs * 4)
+        for result in results:
+            reporting.echo(f"Processing {len(result.renames)} in '{result.folder}':")
+            done = []
+            for rename in result.renames:
+                line = f"  {test}{rename.source.name} -> {rename.target.name} "
+                err = result.failures.get(rename.source)
+                if rename.skipped:
+                    reporting.echo(f"{line}{utils.emphasis_str("SKIPPED")}: Already exists.")
+                    reporting.record("rename", "skipped", src=rename.source, dst=rename.target, reason="exists")
+                    skipped += 1
+                elif err is not None:
+                    reporting.warn(f"{line}{utils.error_str(str(err))}")
+                    reporting.record("rename", "error", src=rename.source, dst=rename.target, error=str(err))
+                    failed += 1
+                else:
+                    reporting.echo(f"{line}{utils.emphasis_str("OK")}")
+                    reporting.record("rename", status, src=rename.source, dst=rename.target)
+                    done.append((rename.source, rename.target))
+            if done and not test_only and (catalog := catalog_for(done[0][0])) is not None:
+                catalog.rename(done)
+            renamed += len(done)
+
+    reporting.echo(f"{"Would rename" if test_only else "Renamed"} {renamed} files in {len(folders)} folders{f", skipped {skipped}" if skipped else ""}.")
+    if failed:
+        reporting.warn(utils.error_str(f"{failed} files could not be renamed."))
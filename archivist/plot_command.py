@@ -1,65 +1,114 @@
-import pathlib
-import click, exif
-import plotly.graph_objects as go
+import os, pathlib
 
 from collections import Counter
 from typing import Iterable
 
-from . import utils
+from . import aggregation, concurrency, extraction, reporting, utils
+from .catalog import Catalog, Filters, find_common_catalog_root
 from .count_command import collect_file_suffix_stats
+from .metadata_cache import MetadataCache, find_cache_root, open_cache
 
-def collect_focal_lengths(files: Iterable[pathlib.Path]) -> Iterable[str]:
-    def collect(file: pathlib.Path) -> str | None:
-        with file.open("rb") as fo:
-            try:
-                image = exif.Image(fo)
-            except:
-                click.echo(utils.warn_str(f"Unable to read file '{file}'. Skipping..."))
-                return None
-        if not image.has_exif:
-            click.echo(utils.warn_str(f"No EXIF tags in file '{file}'. Skipping..."))
-            return None
-        else:
-            try:
-                return image.focal_length_in_35mm_film
-            except:
-                click.echo(utils.warn_str(f"No 'focal_length_in_35mm_film' EXIF tag in file '{file}'. Skipping..."))
-                return None
-    return [collect(f) for f in files]
+def collect_metadata_columns(files: Iterable[pathlib.Path],
+                             dimension: str,
+                             group_by: str,
+                             cache: MetadataCache | None = None,
+                             jobs: int = concurrency.DEFAULT_JOBS,
+                             processes: bool = False,
+                             file_stats: dict[pathlib.Path, os.stat_result] | None = None) -> dict[str, aggregation.MetadataColumns]:
+    warnings = []
+    def checked(results: Iterable[extraction.FileMetadata]) -> Iterable[extraction.FileMetadata]:
+        for result in results:
+            warnings.extend(result.warnings)
+            if result.tags is None and not result.warnings:
+                warnings.append(utils.warn_str(f"No EXIF tags in file '{result.path}'. Skipping..."))
+            yield result
 
-def generate_graph(out_file : pathlib.Path | None, focal_lengths: Iterable):
-    counts = Counter(sorted(focal_lengths))
+    tags = aggregation.required_tags([dimension], group_by)
+    shards = aggregation.collect_columns(checked(extraction.extract_metadata(files, tags, cache, jobs, processes, file_stats)), [dimension], group_by)
+    for warning in warnings:
+        reporting.warn(warning)
+    return shards
 
-    x = [f"{focal_len}mm" for focal_len in counts.keys()]
-    y = list(counts.values())
+def generate_graph(out_file : pathlib.Path | None, dimension: aggregation.Dimension, partials: dict[str, aggregation.PartialStats]):
+    import plotly.graph_objects as go # Slow to import, so only once there's something to plot
+    total = aggregation.merge(partials.values()).histograms.get(dimension.name, Counter())
+    keys = aggregation.sorted_keys(dimension, total)
+    x = [dimension.format(key) for key in keys]
 
-    fig = go.Figure(data=[go.Bar(x=x, y=y,
-                                 text=y, 
-                                 textposition="auto")],
-                    layout_title_text=f"Focal lengths for {len(focal_lengths)} images:")
-    fig.update_layout(xaxis_tickangle=-45)
+    bars = []
+    for group, partial in sorted(partials.items()):
+        counts = partial.histograms[dimension.name]
+        y = [counts.get(key, 0) for key in keys]
+        bars.append(go.Bar(x=x, y=y, name=group or None, text=y, textposition="auto"))
+
+    fig = go.Figure(data=bars, layout_title_text=f"{dimension.title} for {total.total()} images:")
+    fig.update_layout(xaxis_tickangle=-45, showlegend=len(bars) > 1)
 
     if out_file is not None:
         target_file = out_file.with_suffix(".html")
         fig.write_html(file=target_file)
-        click.echo(f"{utils.emphasis_str("Saved plot to")} '{target_file}'.")
+        reporting.echo(f"{utils.emphasis_str("Saved plot to")} '{target_file}'.")
     else:
         fig.show()
 
-def plot(folders: Iterable[pathlib.Path], out_file: pathlib.Path | None, raw_only: bool, processed_only: bool):
+def plot(folders: Iterable[pathlib.Path], out_file: pathlib.Path | None, raw_only: bool, processed_only: bool,
+         archive: pathlib.Path | None = None, no_cache: bool = False, rebuild_cache: bool = False,
+         jobs: int = concurrency.DEFAULT_JOBS, processes: bool = False,
+         dimension: str = "focal_length", group_by: str = "none", use_catalog: bool = False):
+    folders = list(folders)
     accepted_suffixes = set()
     if not raw_only:
         accepted_suffixes |= utils.PROCESSED_EXTS
     if not processed_only:
         accepted_suffixes |= utils.RAW_EXTS
 
-    click.echo("Collecting image files... ", nl=False)
-    image_files = list(utils.collect_image_files(folders, recurse=True, accepted_suffixes=accepted_suffixes))
-    click.echo(f"found {len(image_files)}.")
-    click.echo(f"  {collect_file_suffix_stats(image_files).format_suffixes()}")
+    plot_dimension = aggregation.DIMENSIONS[dimension]
+    # Only an archive's catalog and cache, never new ones wherever plot happens to be run
+    catalog_root = None
+    if use_catalog:
+        if archive is None:
+            catalog_root = find_common_catalog_root(folders or [pathlib.Path(".")])
+        elif all(folder.absolute().is_relative_to(archive.absolute()) for folder in folders):
+            catalog_root = archive
+        if catalog_root is None:
+            reporting.warn(utils.warn_str("No catalog covers all the given folders - reading the files instead."))
+
+    cache_stats = None
+    if catalog_root is not None:
+        reporting.echo(f"Reading {plot_dimension.title.lower()} from the catalog... ", nl=False)
+        with Catalog(catalog_root) as catalog:
+            with reporting.stage("refresh"), open_cache(archive or find_cache_root([catalog_root]), no_cache, rebuild_cache) as cache:
+                catalog.refresh(jobs=jobs, cache=cache)
+            with reporting.stage("metadata"):
+                results = list(catalog.files(Filters(folders=folders, suffixes=accepted_suffixes)))
+                shards = aggregation.collect_columns(results, [dimension], group_by)
+        file_count = len(results)
+    else:
+        reporting.echo("Collecting image files... ", nl=False)
+        with reporting.stage("collect"):
+            file_stats = dict(utils.collect_image_file_stats(folders, recurse=True, accepted_suffixes=accepted_suffixes, jobs=jobs))
+        image_files = list(file_stats)
+        file_count = len(image_files)
+        reporting.echo(f"found {len(image_files)}.")
+        reporting.echo(f"  {collect_file_suffix_stats(image_files).format_suffixes()}")
+
+        reporting.echo(f"Collecting {plot_dimension.title.lower()}... ", nl=False)
+        with open_cache(archive if archive is not None else find_cache_root(folders), no_cache, rebuild_cache) as cache:
+            with reporting.stage("metadata"):
+                shards = collect_metadata_columns(image_files, dimension, group_by, cache, jobs, processes, file_stats)
+            if cache is not None:
+                cache_stats = cache.format_stats()
 
-    click.echo("Collecting focal lengths... ", nl=False)
-    focal_length_data = collect_focal_lengths(image_files)
-    click.echo(f"found {len(focal_length_data)}.")
+    with reporting.stage("aggregate"):
+        partials = aggregation.summarize(shards, jobs, processes)
+    found = sum(p.histograms[dimension].total() for p in partials.values())
+    reporting.echo(f"found {found}.")
+    reporting.count("files", file_count)
+    reporting.count(dimension, found)
+    if found < file_count:
+        reporting.warn(utils.warn_str(f"No {plot_dimension.name} data in {file_count - found} files."))
+    if cache_stats is not None:
+        reporting.echo(cache_stats)
 
-    generate_graph(out_file, focal_length_data)
+    with reporting.stage("render"):
+        generate_graph(out_file, plot_dimension, partials)
@@ -0,0 +1,44 @@
+import pathlib, time
+
+from typing import Callable
+
+from . import reporting
+
+
+class Progress:
+    """Status line with throughput figures, redrawn in place below the regular output when writing to a terminal."""
+
+    REFRESH_INTERVAL = 0.1
+
+    def __init__(self, label: str, details: Callable[[], str] | None = None, size: Callable[[pathlib.Path], int] | None = None):
+        self.label = label
+        self.details = details
+        self.size = size if size is not None else lambda file: file.stat().st_size
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._last_draw = 0.0
+
+    def advance(self, file: pathlib.Path):
+        self.files += 1
+        self.bytes += self.size(file)
+        self._draw()
+
+    def format_throughput(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        megabytes = self.bytes / 1e6
+        return f"{self.files} files, {megabytes:.1f} MB in {elapsed:.1f}s ({self.files / elapsed:.1f} files/s, {megabytes / elapsed:.1f} MB/s)"
+
+    def finish(self):
+        reporting.status(None)
+        reporting.echo(f"{self.label}: {self.format_throughput()}")
+
+    def _draw(self):
+        now = time.monotonic()
+        if now - self._last_draw < self.REFRESH_INTERVAL:
+            return
+        status = f"{self.label}: {self.format_throughput()}"
+        if self.details is not None:
+            status += f" - {self.details()}"
+        reporting.status(status)
+        self._last_draw = now
@@ -0,0 +1,38 @@
+import pathlib
+
+from . import aggregation, concurrency, reporting, utils
+from .catalog import Catalog, Filters
+from .metadata_cache import find_cache_root, open_cache
+
+
+def format_entry(path: pathlib.Path, tags: dict | None) -> str:
+    tags = tags or {}
+    fields = [
+        tags.get("datetime_original") or "-",
+        aggregation.camera_name(tags) or "-",
+        tags.get("lens_model") or "-",
+        f"{tags["focal_length_in_35mm_film"]}mm" if tags.get("focal_length_in_35mm_film") else "-",
+        f"f/{tags["f_number"]:g}" if tags.get("f_number") else "-",
+        f"ISO {tags["photographic_sensitivity"]}" if tags.get("photographic_sensitivity") else "-",
+    ]
+    return f"{path}  {utils.emphasis_str(" | ".join(str(f) for f in fields))}"
+
+def query(archive: pathlib.Path, filters: Filters, long: bool, count_only: bool, full_refresh: bool, jobs: int = concurrency.DEFAULT_JOBS):
+    if not archive.is_dir():
+        reporting.warn(utils.error_str("Archive folder doesn't exist. Exiting."))
+        return
+
+    with Catalog(archive) as catalog:
+        with reporting.stage("refresh"), open_cache(find_cache_root([archive]), False, False) as cache:
+            changed, removed = catalog.refresh(full_refresh, jobs, cache)
+        if changed or removed:
+            reporting.echo(f"Catalog updated: {changed} new or changed, {removed} removed files.")
+
+        matches = 0
+        with reporting.stage("query"):
+            for result in catalog.files(filters):
+                matches += 1
+                reporting.record("match", path=result.path, **(result.tags or {}))
+                if not count_only:
+                    reporting.echo(format_entry(result.path, result.tags) if long else str(result.path))
+    reporting.echo(f"{matches} files.")
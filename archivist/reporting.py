@@ -0,0 +1,162 @@
+import atexit, contextlib, json, sys, threading, time
+import click
+
+from collections import Counter
+from typing import Any, Iterator
+
+from . import instrumentation
+
+OUTPUT_MODES = ["text", "json", "ndjson", "quiet"]
+
+
+class Reporter:
+    """
+    Output of a command run, written in batches rather than line by line.
+
+    In "text" mode, messages are printed as usual and records are only counted. In "ndjson" mode, every record
+    is printed as a JSON line, and in "json" mode all records are printed as one document at the end. Either way,
+    the run ends with a summary of counts, bytes, elapsed time and stage timings. Messages are dropped in the
+    machine-readable modes and in "quiet" mode, while warnings and errors go to stderr.
+    """
+
+    FLUSH_LINES = 512
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self, mode: str = "text", command: str | None = None):
+        self.mode = mode
+        self.command = command
+        self.counts: Counter = Counter()
+        self.bytes = 0
+        self.stages: dict[str, float] = dict()
+        self.records: list[dict[str, Any]] = []
+        self.started = time.monotonic()
+        self._buffer: list[str] = []
+        self._status: str | None = None
+        self._status_shown: str | None = None
+        self._last_flush = self.started
+        self._interactive = sys.stdout.isatty()
+        self._lock = threading.RLock()
+
+    @property
+    def is_text(self) -> bool:
+        return self.mode == "text"
+
+    def echo(self, message: str = "", nl: bool = True):
+        if self.is_text:
+            self._write(message + ("\n" if nl else ""))
+
+    def warn(self, message: str):
+        """Warnings and errors, which are printed in every mode."""
+        if self.is_text:
+            self.echo(message)
+        else:
+            click.echo(message, err=True)
+
+    def record(self, action: str, status: str = "ok", **fields: Any):
+        """A structured record of something done to a single file."""
+        with self._lock:
+            self.counts[action if status == "ok" else f"{action}_{status}"] += 1
+            if status == "ok":
+                self.bytes += fields.get("bytes") or 0
+            if self.mode == "ndjson":
+                self._write(json.dumps({"type": "file", "action": action, "status": status, **fields}, default=str) + "\n")
+            elif self.mode == "json":
+                self.records.append({"action": action, "status": status, **fields})
+
+    def status(self, line: str | None):
+        """Set or clear a status line kept below the regular output - only shown on a terminal, in text mode."""
+        if self.is_text and self._interactive:
+            with self._lock:
+                self._status = line
+                self.flush()
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] += n
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the run. Pending text is shown first, as the stage may take a while."""
+        self.flush()
+        started = time.monotonic()
+        try:
+            with instrumentation.span(name, "stage"):
+                yield
+        finally:
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - started
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "command": self.command,
+            "counts": dict(self.counts),
+            "bytes": self.bytes,
+            "elapsed": round(time.monotonic() - self.started, 6),
+            "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+        }
+
+    def finish(self):
+        if self.mode == "ndjson":
+            self._write(json.dumps({"type": "summary", **self.summary()}, default=str) + "\n")
+        elif self.mode == "json":
+            self._write(json.dumps({"files": self.records, "summary": self.summary()}, default=str) + "\n")
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            text = "".join(self._buffer)
+            self._buffer.clear()
+            if text or self._status != self._status_shown:
+                if self._status_shown is not None:
+                    text = "\r\x1b[2K" + text
+                if self._status is not None:
+                    text += self._status
+                self._status_shown = self._status
+                with instrumentation.span("write_output"):
+                    if self.is_text:
+                        # click.echo strips the styling when not writing to a terminal
+                        click.echo(text, nl=False)
+                    else:
+                        sys.stdout.write(text)
+                    sys.stdout.flush()
+            self._last_flush = time.monotonic()
+
+    def _write(self, text: str):
+        with self._lock:
+            self._buffer.append(text)
+            if len(self._buffer) >= self.FLUSH_LINES or (self._interactive and time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL):
+                self.flush()
+
+
+_reporter = Reporter()
+# Library use without the CLI, which finishes its reporter when a command is done
+atexit.register(lambda: _reporter.flush())
+
+def current() -> Reporter:
+    return _reporter
+
+def use(reporter: Reporter) -> Reporter:
+    global _reporter
+    _reporter = reporter
+    return reporter
+
+def echo(message: str = "", nl: bool = True):
+    _reporter.echo(message, nl)
+
+def warn(message: str):
+    _reporter.warn(message)
+
+def record(action: str, status: str = "ok", **fields: Any):
+    _reporter.record(action, status, **fields)
+
+def flush():
+    _reporter.flush()
+
+def status(line: str | None):
+    _reporter.status(line)
+
+def count(name: str, n: int = 1):
+    _reporter.count(name, n)
+
+def stage(name: str) -> contextlib.AbstractContextManager[None]:
+    return _reporter.stage(name)
@@ -0,0 +1,50 @@
+import re, subprocess, sys
+
+import click
+
+from dataclasses import dataclass
+from typing import Iterable
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)$")
+
+
+@dataclass
+class ImportTime:
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def parse_import_times(lines: Iterable[str]) -> tuple[list[ImportTime], list[str]]:
+    """Split `python -X importtime` output from the rest of stderr."""
+    times = []
+    other_lines = []
+    for line in lines:
+        match = IMPORT_TIME_LINE.match(line.rstrip("\n"))
+        if match:
+            self_us, cumulative_us, module = match.groups()
+            times.append(ImportTime(module, int(self_us), int(cumulative_us)))
+        elif not line.startswith("import time:"):
+            other_lines.append(line)
+    return times, other_lines
+
+def format_report(times: list[ImportTime], top: int) -> list[str]:
+    total = sum(t.self_us for t in times)
+    is_own = lambda t: t.module.split(".")[0] == "archivist"
+    archivist = [t for t in times if is_own(t)]
+    heaviest = sorted((t for t in times if not is_own(t)), key=lambda t: t.self_us, reverse=True)[:top]
+    lines = [f"{click.style("Startup imports", fg="blue")}: {len(times)} modules in {total / 1000:.1f} ms"]
+    lines.append("  archivist modules (cumulative):")
+    lines.extend(f"    {t.cumulative_us / 1000:8.1f} ms  {t.module}" for t in archivist)
+    lines.append(f"  {len(heaviest)} slowest other modules (self):")
+    lines.extend(f"    {t.self_us / 1000:8.1f} ms  {t.module}" for t in heaviest)
+    return lines
+
+def profile_startup(args: list[str], top: int = 15) -> int:
+    """Run archivist with the given arguments under `-X importtime`, then report what its imports cost."""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-m", "archivist", *args], stderr=subprocess.PIPE, text=True)
+    times, other_lines = parse_import_times(process.stderr.splitlines(keepends=True))
+    sys.stderr.writelines(other_lines)
+    for line in format_report(times, top):
+        click.echo(line, err=True)
+    return process.returncode
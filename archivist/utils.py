@@ -1,9 +1,13 @@
-import pathlib
+import os, pathlib, stat, struct, sys, time
 
 import click
-import exif
 
-from typing import Iterable
+from collections import defaultdict
+from concurrent.futures import Executor, Future
+from typing import Any, Iterable, Iterator, Mapping
+
+from . import concurrency, instrumentation, metadata, reporting
+from .metadata_cache import MetadataCache
 
 RAW_EXTS = {".raf", ".nef", ".orf", ".rw2", ".crw", ".cr2", ".arw", ".dng"}
 PROCESSED_EXTS = {".jpeg", ".jpg", ".heif", ".hif", ".heic"}
@@ -13,6 +17,13 @@ FILE_EXT_NORMALIZATIONS = {
     ".hif": ".heif",
     ".heic": ".heif",
 }
+# Folders modified this recently are listed again on the next scan, as further changes within the same mtime tick would go unnoticed
+MTIME_GRACE_NS = 2_000_000_000
+
+
+class ExifReadError(Exception):
+    pass
+
 
 def warn_str(s: str) -> str:
     return f"{click.style("WARNING", fg="yellow")}: {s}"
@@ -23,30 +34,180 @@ def error_str(s: str) -> str:
 def emphasis_str(s: str) -> str:
     return click.style(s, fg="blue")
 
-def collect_image_files(paths: Iterable[pathlib.Path], files_only: bool = False, recurse: bool = False, accepted_suffixes: set[str] = IMAGE_EXTS) -> Iterable[pathlib.Path]:
-    for path in paths:
-        if not path.exists():
-            continue
-        elif path.is_file():
-            if path.suffix.lower() in accepted_suffixes:
-                yield path
-        elif path.is_dir():
-            if files_only:
+def has_accepted_suffix(name: str, accepted_suffixes: set[str]) -> bool:
+    return os.path.splitext(name)[1].lower() in accepted_suffixes
+
+def scan_directory(directory: str) -> list[tuple[os.DirEntry, bool]]:
+    """List a directory once, flagging subdirectories using the type info returned by the listing itself."""
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                if entry.is_file():
+                    entries.append((entry, False))
+                elif entry.is_dir():
+                    entries.append((entry, True))
+            except OSError:
+                continue
+    instrumentation.add("directories_listed")
+    instrumentation.add("entries_listed", len(entries))
+    return entries
+
+def walk_image_entries(paths: Iterable[pathlib.Path],
+                       files_only: bool = False,
+                       recurse: bool = False,
+                       accepted_suffixes: set[str] = IMAGE_EXTS,
+                       with_stats: bool = False,
+                       jobs: int = 1) -> Iterator[tuple[str, str, os.stat_result | None]]:
+    """
+    Iterative os.scandir based walk yielding (folder, name, stat) triples, stat being None unless with_stats is set.
+    All files of a folder share one interned folder string, so callers keeping many files needn't keep a path per file.
+
+    With jobs > 1, the subdirectories of each listed directory are listed ahead of time on a thread pool,
+    which helps on high-latency network filesystems. The output order is the same either way.
+    """
+    prefetch = jobs > 1 and recurse
+
+    def listing(directory: str, future: Future | None, executor: Executor) -> list[tuple[os.DirEntry, bool, Future | None]]:
+        entries = future.result() if future is not None else scan_directory(directory)
+        return [(entry, is_dir, executor.submit(scan_directory, entry.path) if is_dir and prefetch else None) for entry, is_dir in entries]
+
+    with concurrency.make_executor(jobs) as executor:
+        for path in paths:
+            try:
+                path_stat = os.stat(path)
+            except (OSError, ValueError):
                 continue
+            if stat.S_ISREG(path_stat.st_mode):
+                if has_accepted_suffix(path.name, accepted_suffixes):
+                    yield sys.intern(str(path.parent)), path.name, path_stat if with_stats else None
+                continue
+            elif not stat.S_ISDIR(path_stat.st_mode) or files_only:
+                continue
+
+            stack = [(sys.intern(str(path)), iter(listing(str(path), None, executor)))]
+            while stack:
+                folder, entries = stack[-1]
+                item = next(entries, None)
+                if item is None:
+                    stack.pop()
+                    continue
+                entry, is_dir, future = item
+                if is_dir:
+                    if recurse:
+                        stack.append((sys.intern(entry.path), iter(listing(entry.path, future, executor))))
+                elif has_accepted_suffix(entry.name, accepted_suffixes):
+                    try:
+                        entry_stat = entry.stat() if with_stats else None
+                    except OSError:
+                        continue
+                    if with_stats:
+                        instrumentation.add("stat_calls")
+                    yield folder, entry.name, entry_stat
+
+def scan_changed_folders(root: pathlib.Path,
+                         known_folders: Mapping[str, tuple[str | None, int | None]],
+                         full: bool = False) -> Iterator[tuple[str, str | None, int | None, list[os.DirEntry] | None]]:
+    """
+    Walk the folders below root, listing only those whose modification time differs from the one recorded in known_folders
+    (path -> (parent, mtime_ns)) and reaching the subfolders of unchanged ones through the recorded parents.
+
+    Yields (folder, parent, mtime_ns, files) for every folder found. files is None for unchanged folders, and mtime_ns
+    is None for folders modified too recently to be trusted as unchanged next time.
+    """
+    subfolders = defaultdict(list)
+    for path, (parent, _) in known_folders.items():
+        subfolders[parent].append(path)
+    now_ns = time.time_ns()
+    stack = [(str(root.absolute()), None)]
+    while stack:
+        folder, parent = stack.pop()
+        try:
+            mtime_ns = os.stat(folder).st_mtime_ns
+        except OSError:
+            continue
+        known = known_folders.get(folder)
+        if not full and known is not None and known[1] == mtime_ns:
+            stack.extend((subfolder, folder) for subfolder in subfolders[folder])
+            yield folder, parent, mtime_ns, None
+            continue
+        files = []
+        for entry, is_dir in scan_directory(folder):
+            if is_dir:
+                stack.append((entry.path, folder))
             else:
-                yield from collect_image_files(path.iterdir(), not recurse, recurse, accepted_suffixes=accepted_suffixes)
+                files.append(entry)
+        yield folder, parent, None if now_ns - mtime_ns < MTIME_GRACE_NS else mtime_ns, files
+
+def prefix_range(folder: pathlib.Path | str) -> tuple[str, str]:
+    """Bounds of all paths below a folder, for an indexed range query."""
+    prefix = os.path.join(str(pathlib.Path(folder).absolute()), "")
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+def walk_image_files(paths: Iterable[pathlib.Path],
+                     files_only: bool = False,
+                     recurse: bool = False,
+                     accepted_suffixes: set[str] = IMAGE_EXTS,
+                     with_stats: bool = False,
+                     jobs: int = 1) -> Iterator[tuple[pathlib.Path, os.stat_result | None]]:
+    """Like walk_image_entries, yielding (path, stat) pairs."""
+    for folder, name, entry_stat in walk_image_entries(paths, files_only, recurse, accepted_suffixes, with_stats, jobs):
+        yield pathlib.Path(folder, name), entry_stat
 
-def read_exif_tag(file: pathlib.Path, tag: str) -> str | None:
+def collect_image_files(paths: Iterable[pathlib.Path], files_only: bool = False, recurse: bool = False, accepted_suffixes: set[str] = IMAGE_EXTS, jobs: int = 1) -> Iterable[pathlib.Path]:
+    for path, _ in walk_image_files(paths, files_only, recurse, accepted_suffixes, jobs=jobs):
+        yield path
+
+def collect_image_file_stats(paths: Iterable[pathlib.Path], files_only: bool = False, recurse: bool = False, accepted_suffixes: set[str] = IMAGE_EXTS, jobs: int = 1) -> Iterable[tuple[pathlib.Path, os.stat_result]]:
+    return walk_image_files(paths, files_only, recurse, accepted_suffixes, with_stats=True, jobs=jobs)
+
+def read_exif_tags(file: pathlib.Path, tags: Iterable[str], cache: MetadataCache | None = None) -> dict[str, Any] | None:
+    tags = tuple(tags)
+    if cache is not None:
+        file_stat = file.stat()
+        values = cache.get(file, file_stat, tags)
+        if values is not MetadataCache.MISS:
+            return values
+    try:
+        values = read_exif_tags_uncached(file, tags if cache is None else cache.tags_to_read(tags))
+    except ExifReadError as err:
+        reporting.warn(warn_str(str(err)))
+        return None
+    if cache is not None:
+        cache.put(file, file_stat, values)
+    if values is None:
+        return None
+    else:
+        return {tag: values[tag] for tag in tags}
+
+@instrumentation.instrumented("read_exif_tags")
+def read_exif_tags_uncached(file: pathlib.Path, tags: tuple[str, ...]) -> dict[str, Any] | None:
+    try:
+        return metadata.read_tags(file, tags)
+    except (metadata.UnsupportedFormat, OSError, ValueError, ZeroDivisionError, struct.error):
+        # Unknown format or malformed header - let the exif library have a go at the whole file
+        pass
+    import exif # Slow to import, and only needed for formats the header parser doesn't handle
     with file.open("rb") as fo:
         try:
             image = exif.Image(fo)
             if image.has_exif:
-                return image.get(tag)
+                return {tag: image.get(tag) for tag in tags}
             else:
                 return None
-        except:
-            click.echo(warn_str(f"Unable to read EXIF tags on file '{file}'"))
-            return None
+        except Exception as err:
+            raise ExifReadError(f"Unable to read EXIF tags on file '{file}'") from err
+
+def read_exif_tag(file: pathlib.Path, tag: str, cache: MetadataCache | None = None) -> Any | None:
+    tags = read_exif_tags(file, [tag], cache)
+    if tags is None:
+        return None
+    else:
+        return tags[tag]
+
+def normalize_suffix_str(suffix: str) -> str:
+    suffix = suffix.lower()
+    return FILE_EXT_NORMALIZATIONS.get(suffix, suffix)
 
 def normalize_suffix(file: pathlib.Path) -> pathlib.Path:
     file = file.with_suffix(file.suffix.lower())
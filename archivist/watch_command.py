@@ -0,0 +1,239 @@
+import ctypes, ctypes.util, os, pathlib, select, signal, struct, time
+
+from typing import Iterable
+
+from . import concurrency, reporting, transfer, utils
+from .catalog import open_catalog
+from .constants import DEFAULT_BATCH_SIZE, DEFAULT_POLL_INTERVAL, DEFAULT_SETTLE_TIME
+from .content_index import ContentIndex, open_index
+from .import_command import ImportPlanner, filter_duplicates, open_journal, perform_import, process_input_files
+from .journal import ImportJournal
+from .metadata_cache import open_cache
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Reports files created, written or moved into the watched directories, blocking without CPU use until there are any."""
+
+    MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+
+    def __init__(self, paths: Iterable[pathlib.Path], recurse: bool):
+        self.paths = list(paths)
+        self.recurse = recurse
+        self.directories: dict[int, pathlib.Path] = dict()
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for path in self.paths:
+            self._add_tree(path)
+
+    def close(self):
+        os.close(self._fd)
+
+    def scan(self) -> list[pathlib.Path]:
+        return list(utils.collect_image_files(self.paths, recurse=self.recurse))
+
+    def wait(self, timeout: float | None) -> set[pathlib.Path]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        files = set()
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost - look at everything again
+                files.update(self.scan())
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / name
+            if mask & IN_ISDIR:
+                if self.recurse and mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have landed in the new directory before it was watched
+                    self._add_tree(path)
+                    files.update(utils.collect_image_files([path], recurse=True))
+            elif utils.has_accepted_suffix(name, utils.IMAGE_EXTS):
+                files.add(path)
+        return files
+
+    def _add_tree(self, root: pathlib.Path):
+        for directory in ([root] if not self.recurse else (pathlib.Path(d) for d, _, _ in os.walk(root))):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+            if wd >= 0:
+                self.directories[wd] = directory
+
+    def _read_events(self) -> Iterable[tuple[int, int, str]]:
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                yield wd, mask, name
+
+
+class PollingWatcher:
+    """Fallback for systems without inotify: rescans the watched directories every poll interval."""
+
+    def __init__(self, paths: Iterable[pathlib.Path], recurse: bool, interval: float = DEFAULT_POLL_INTERVAL):
+        self.paths = list(paths)
+        self.recurse = recurse
+        self.interval = interval
+        self.snapshot: dict[pathlib.Path, tuple[int, int]] = dict()
+        self.next_scan = time.monotonic() + interval
+
+    def close(self):
+        pass
+
+    def scan(self) -> list[pathlib.Path]:
+        self.snapshot = {file: (stat.st_size, stat.st_mtime_ns)
+                         for file, stat in utils.collect_image_file_stats(self.paths, recurse=self.recurse)}
+        self.next_scan = time.monotonic() + self.interval
+        return list(self.snapshot)
+
+    def wait(self, timeout: float | None) -> set[pathlib.Path]:
+        delay = self.next_scan - time.monotonic()
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(delay, 0))
+        previous = self.snapshot
+        self.scan()
+        return {file for file, signature in self.snapshot.items() if previous.get(file) != signature}
+
+
+class Debouncer:
+    """Holds back files until their size and modification time haven't changed for the settle time."""
+
+    def __init__(self, settle_time: float = DEFAULT_SETTLE_TIME):
+        self.settle_time = settle_time
+        self.pending: dict[pathlib.Path, tuple[tuple[int, int] | None, float]] = dict()
+
+    def add(self, files: Iterable[pathlib.Path]):
+        for file in files:
+            self.pending[file] = (None, time.monotonic())
+
+    def timeout(self) -> float | None:
+        return self.settle_time if self.pending else None
+
+    def ready(self) -> dict[pathlib.Path, os.stat_result]:
+        now = time.monotonic()
+        ready = dict()
+        for file, (signature, since) in list(self.pending.items()):
+            try:
+                stat = file.stat()
+            except OSError:
+                # Gone again, e.g. a temporary file
+                del self.pending[file]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.pending[file] = (current, now)
+            elif now - since >= self.settle_time:
+                ready[file] = stat
+                del self.pending[file]
+        return ready
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+def make_watcher(paths: Iterable[pathlib.Path], recurse: bool, poll: bool, poll_interval: float) -> InotifyWatcher | PollingWatcher:
+    if not poll:
+        try:
+            return InotifyWatcher(paths, recurse)
+        except (OSError, AttributeError):
+            # No inotify on this system (AttributeError: libc doesn't have the functions)
+            reporting.warn(utils.warn_str(f"inotify isn't available, polling every {poll_interval:g}s instead."))
+    return PollingWatcher(paths, recurse, poll_interval)
+
+def import_batch(archive: pathlib.Path,
+                 file_stats: dict[pathlib.Path, os.stat_result],
+                 planner: ImportPlanner,
+                 index: ContentIndex,
+                 move_files: bool,
+                 no_cache: bool,
+                 jobs: int,
+                 copy_jobs: int,
+                 verify: bool = False):
+    with open_cache(archive, no_cache, False) as cache:
+        import_files = list(filter_duplicates(process_input_files(list(file_stats), cache, jobs, False, file_stats), file_stats, index))
+        if not import_files:
+            return
+        by_path = {f.path: f for f in import_files}
+        # Other imports into the archive may have added files since the folders were seeded
+        planner.refresh()
+        with open_journal(archive, move_files, False) as journal, open_catalog(archive) as catalog:
+            while import_files:
+                import_operations = [planner.plan(f) for f in import_files]
+                journal.planned_all((op.original_path, op.canonical_path, file_stats[op.original_path].st_size) for op in import_operations)
+                conflicts = perform_import(import_operations, move_files, False, copy_jobs, journal=journal, catalog=catalog, verify=verify, index=index, cache=cache)
+                for folder in {op.canonical_folder for op in conflicts}:
+                    planner.seed(folder)
+                import_files = [by_path[op.original_path] for op in conflicts]
+                if import_files:
+                    reporting.echo(f"Planning {len(import_files)} files again...")
+
+def watch(archive: pathlib.Path,
+          inboxes: Iterable[pathlib.Path],
+          move_files: bool,
+          recurse: bool,
+          settle_time: float = DEFAULT_SETTLE_TIME,
+          poll: bool = False,
+          poll_interval: float = DEFAULT_POLL_INTERVAL,
+          batch_size: int = DEFAULT_BATCH_SIZE,
+          no_cache: bool = False,
+          jobs: int = concurrency.DEFAULT_JOBS,
+          copy_jobs: int = transfer.DEFAULT_COPY_JOBS,
+          verify: bool = False):
+    """
+    Import image files from inbox folders as they arrive, until interrupted. Files already in the archive
+    are skipped, so files left in the inboxes aren't imported again on every start.
+    """
+    if archive.exists() and ImportJournal(archive).unfinished_runs():
+        reporting.warn(utils.error_str("An earlier import into this archive was interrupted. Complete it with import --resume first. Exiting."))
+        return
+    archive.mkdir(parents=True, exist_ok=True)
+
+    # Stop as gracefully on SIGTERM (e.g. from a service manager) as on Ctrl+C
+    signal.signal(signal.SIGTERM, stop)
+    planner = ImportPlanner(archive)
+    debouncer = Debouncer(settle_time)
+    watcher = make_watcher(inboxes, recurse, poll, poll_interval)
+    try:
+        with open_index(archive, True) as index:
+            reporting.echo("Updating archive content index... ", nl=False)
+            reporting.echo(f"{index.refresh()} new or changed files.")
+            debouncer.add(watcher.scan())
+            reporting.echo(f"Watching {len(inboxes)} folders for new image files - press Ctrl+C to stop.")
+            reporting.flush()
+            while True:
+                debouncer.add(watcher.wait(debouncer.timeout()))
+                ready = list(debouncer.ready().items())
+                for start in range(0, len(ready), batch_size):
+                    file_stats = dict(ready[start:start + batch_size])
+                    reporting.count("found", len(file_stats))
+                    try:
+                        with reporting.stage("import"):
+                            import_batch(archive, file_stats, planner, index, move_files, no_cache, jobs, copy_jobs, verify)
+                    except OSError as err:
+                        reporting.warn(utils.error_str(f"Import failed: {err}. Complete it with import --resume."))
+                        return
+                reporting.flush()
+    except KeyboardInterrupt:
+        reporting.echo("Stopped watching.")
+    finally:
+        watcher.close()
@@ -0,0 +1,116 @@
+"""Generate synthetic photo archives with valid EXIF metadata, for benchmarking."""
+
+import argparse, datetime, pathlib, random, struct
+
+JPEG_SUFFIXES = [".JPG", ".jpg", ".jpeg", ".JPEG"]
+RAW_SUFFIXES = [".RAF", ".NEF", ".dng", ".ARW"]
+CAMERAS = [("FUJIFILM", "X-T5"), ("NIKON CORPORATION", "NIKON Z 6_2"), ("SONY", "ILCE-7M4")]
+LENSES = ["XF23mmF1.4 R LM WR", "NIKKOR Z 50mm f/1.8 S", "FE 35mm F1.8"]
+FOCAL_LENGTHS = [24, 28, 35, 50, 85, 135]
+APERTURES = [(14, 10), (20, 10), (28, 10), (40, 10), (80, 10)]
+ISOS = [100, 200, 400, 800, 1600, 3200, 6400]
+
+
+def tiff_block(endian: str, capture_time: datetime.datetime, rng: random.Random) -> bytes:
+    """A TIFF structure with IFD0 (make, model, Exif pointer) and an Exif IFD with the tags archivist reads."""
+    make, model = rng.choice(CAMERAS)
+    lens = rng.choice(LENSES)
+    values = [
+        # (tag, type, count, payload)
+        (0x010F, 2, make.encode() + b"\x00"),
+        (0x0110, 2, model.encode() + b"\x00"),
+    ]
+    exif_values = [
+        (0x829D, 5, struct.pack(endian + "II", *rng.choice(APERTURES))),
+        (0x8827, 3, struct.pack(endian + "H", rng.choice(ISOS))),
+        (0x9003, 2, capture_time.strftime("%Y:%m:%d %H:%M:%S").encode() + b"\x00"),
+        (0xA405, 3, struct.pack(endian + "H", rng.choice(FOCAL_LENGTHS))),
+        (0xA434, 2, lens.encode() + b"\x00"),
+    ]
+    type_sizes = {2: 1, 3: 2, 5: 8}
+
+    def ifd(entries, offset, extra_entries=()):
+        """Serialize an IFD at the given offset, with out-of-line values stored right after it."""
+        count = len(entries) + len(extra_entries)
+        data_offset = offset + 2 + count * 12 + 4
+        table = struct.pack(endian + "H", count)
+        data = b""
+        for tag, field_type, payload in sorted([*entries, *extra_entries]):
+            value_count = len(payload) // type_sizes.get(field_type, 4)
+            if len(payload) <= 4:
+                table += struct.pack(endian + "HHI", tag, field_type, value_count) + payload.ljust(4, b"\x00")
+            else:
+                table += struct.pack(endian + "HHII", tag, field_type, value_count, data_offset + len(data))
+                data += payload + (b"\x00" if len(payload) % 2 else b"")
+        return table + struct.pack(endian + "I", 0) + data
+
+    header = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HI", 42, 8)
+    # IFD0 size is known up front: entries + the Exif pointer entry
+    ifd0_size = len(ifd(values, 8, [(0x8769, 4, b"\x00" * 4)]))
+    exif_offset = 8 + ifd0_size
+    ifd0 = ifd(values, 8, [(0x8769, 4, struct.pack(endian + "I", exif_offset))])
+    return header + ifd0 + ifd(exif_values, exif_offset)
+
+def jpeg_file(capture_time: datetime.datetime, size: int, rng: random.Random) -> bytes:
+    app1 = b"Exif\x00\x00" + tiff_block("<", capture_time, rng)
+    head = b"\xff\xd8" + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xda" + struct.pack(">H", 2)
+    return head + rng.randbytes(max(0, size - len(head) - 2)) + b"\xff\xd9"
+
+def raw_file(suffix: str, capture_time: datetime.datetime, size: int, rng: random.Random) -> bytes:
+    if suffix.lower() == ".raf":
+        jpeg = jpeg_file(capture_time, 4096, rng)
+        header = b"FUJIFILMCCD-RAW 0201FF129502".ljust(84, b"\x00") + struct.pack(">II", 100, len(jpeg))
+        data = header.ljust(100, b"\x00") + jpeg
+    else:
+        data = tiff_block(">" if suffix.lower() == ".nef" else "<", capture_time, rng)
+    return data + rng.randbytes(max(0, size - len(data)))
+
+def generate(root: pathlib.Path, files: int, years: int, raw_ratio: float, orphan_ratio: float, file_size: int, seed: int) -> dict:
+    """
+    Lay out an archive as root/archive/YYYY/MM/ with processed files and a raw/ subfolder of RAW files,
+    some of them paired with a processed file and some orphaned, plus a flat card dump in root/inbox/.
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2024 - years, 1, 1)
+    span = datetime.timedelta(days=365 * years).total_seconds()
+    counts = {"processed": 0, "raw": 0, "inbox": 0}
+    for i in range(files):
+        capture_time = start + datetime.timedelta(seconds=int(rng.random() * span))
+        folder = root / "archive" / capture_time.strftime("%Y") / capture_time.strftime("%m")
+        stem = f"DSCF{i:06}"
+        if rng.random() >= orphan_ratio:
+            folder.mkdir(parents=True, exist_ok=True)
+            (folder / (stem + rng.choice(JPEG_SUFFIXES))).write_bytes(jpeg_file(capture_time, file_size, rng))
+            counts["processed"] += 1
+            if rng.random() >= raw_ratio:
+                continue
+        raw_folder = folder / "raw"
+        raw_folder.mkdir(parents=True, exist_ok=True)
+        suffix = rng.choice(RAW_SUFFIXES)
+        (raw_folder / (stem + suffix)).write_bytes(raw_file(suffix, capture_time, file_size, rng))
+        counts["raw"] += 1
+
+    inbox = root / "inbox" / "DCIM" / "100CAMERA"
+    inbox.mkdir(parents=True, exist_ok=True)
+    for i in range(max(1, files // 10)):
+        # Bursts of several shots per second, to exercise the collision numbering
+        capture_time = start + datetime.timedelta(seconds=int(rng.random() * span) // 4 * 4)
+        (inbox / f"IMG_{i:05}{rng.choice(JPEG_SUFFIXES)}").write_bytes(jpeg_file(capture_time, file_size, rng))
+        counts["inbox"] += 1
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=pathlib.Path, help="Directory to create the archive in")
+    parser.add_argument("-n", "--files", type=int, default=2000, help="Number of photos in the archive")
+    parser.add_argument("-y", "--years", type=int, default=5, help="Number of years the capture times are spread over")
+    parser.add_argument("--raw-ratio", type=float, default=0.6, help="Fraction of processed files with a paired RAW file")
+    parser.add_argument("--orphan-ratio", type=float, default=0.1, help="Fraction of photos with only a RAW file")
+    parser.add_argument("--file-size", type=int, default=32 * 1024, help="Size of each generated file in bytes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    counts = generate(args.root, args.files, args.years, args.raw_ratio, args.orphan_ratio, args.file_size, args.seed)
+    print(", ".join(f"{name}: {count}" for name, count in counts.items()))
+
+if __name__ == "__main__":
+    main()
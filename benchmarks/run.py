@@ -0,0 +1,205 @@
+"""
+Time archivist commands end to end and its pipeline stages one by one, on a synthetic archive.
+
+Every benchmark runs in a fresh child process, so peak RSS and syscall counts are its own.
+Results can be saved as a baseline, and compared against one to catch performance regressions.
+"""
+
+import argparse, contextlib, json, os, pathlib, resource, subprocess, sys, tempfile, time
+
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+from archivist import cli, clean_command, import_command, reporting, utils
+from . import generate_archive
+
+
+@dataclass
+class Measurement:
+    name: str
+    elapsed: float
+    files: int
+    read_syscalls: int | None
+    write_syscalls: int | None
+    peak_rss_kb: int
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def read_proc_io() -> dict[str, int]:
+    """Syscall counters of the current process (Linux only)."""
+    try:
+        with open("/proc/self/io") as fo:
+            return {key: int(value) for key, value in (line.split(": ") for line in fo)}
+    except OSError:
+        return {}
+
+def month_folders(root: pathlib.Path) -> list[pathlib.Path]:
+    return sorted(p for p in (root / "archive").glob("*/*") if p.is_dir())
+
+def archive_files(root: pathlib.Path) -> list[pathlib.Path]:
+    return list(utils.collect_image_files([root / "archive"], recurse=True))
+
+def inbox_files(root: pathlib.Path) -> list[pathlib.Path]:
+    return list(utils.collect_image_files([root / "inbox"], recurse=True))
+
+def run_cli(*args: str) -> None:
+    cli.cli.main([str(arg) for arg in args], standalone_mode=False)
+
+# Each benchmark does its setup, and returns a function running the measured part and returning the number of files processed.
+Benchmark = Callable[[pathlib.Path, pathlib.Path], Callable[[], int]]
+
+def stage_collect_image_files(root, scratch):
+    return lambda: len(archive_files(root))
+
+def stage_read_exif_tag(root, scratch):
+    files = archive_files(root)
+    def run():
+        for file in files:
+            utils.read_exif_tag(file, "datetime_original")
+        return len(files)
+    return run
+
+def stage_find_file_matches(root, scratch):
+    pairs = []
+    for folder in month_folders(root):
+        processed = list(utils.collect_image_files([folder], accepted_suffixes=utils.PROCESSED_EXTS))
+        raw = list(utils.collect_image_files([folder / "raw"], accepted_suffixes=utils.RAW_EXTS))
+        pairs.append((processed, raw))
+    def run():
+        return sum(len(clean_command.find_file_matches(processed, raw)) for processed, raw in pairs)
+    return run
+
+def stage_perform_import(root, scratch):
+    files = import_command.process_input_files(inbox_files(root), jobs=1)
+    operations = import_command.make_import_operations(scratch / "archive", files)
+    def run():
+        import_command.perform_import(operations, move_files=False, test_only=False)
+        return len(operations)
+    return run
+
+def command_startup(root, scratch):
+    # A fresh interpreter, to catch slow imports creeping back into startup
+    folder = month_folders(root)[0]
+    return lambda: subprocess.run([sys.executable, "-m", "archivist", "count", str(folder)], stdout=subprocess.DEVNULL, check=True) and 1
+
+def command_count(root, scratch):
+    files = len(archive_files(root))
+    return lambda: run_cli("count", root / "archive") or files
+
+def command_clean(root, scratch):
+    files = len(archive_files(root))
+    return lambda: run_cli("clean", "--test", "--recurse", root / "archive") or files
+
+def command_normalize(root, scratch):
+    files = len(archive_files(root))
+    return lambda: run_cli("normalize", "--test", "--recurse", root / "archive") or files
+
+def command_plot(root, scratch):
+    files = len(archive_files(root))
+    return lambda: run_cli("plot", "--no-cache", "-o", scratch / "plot.html", root / "archive") or files
+
+def command_import_test(root, scratch):
+    files = len(inbox_files(root))
+    return lambda: run_cli("import", "--test", "--no-cache", "--recurse", "-a", scratch / "archive", root / "inbox") or files
+
+def command_import(root, scratch):
+    files = len(inbox_files(root))
+    return lambda: run_cli("import", "--no-cache", "--recurse", "-a", scratch / "archive", root / "inbox") or files
+
+BENCHMARKS: dict[str, Benchmark] = {
+    "stage:collect_image_files": stage_collect_image_files,
+    "stage:read_exif_tag": stage_read_exif_tag,
+    "stage:find_file_matches": stage_find_file_matches,
+    "stage:perform_import": stage_perform_import,
+    "command:startup": command_startup,
+    "command:count": command_count,
+    "command:clean": command_clean,
+    "command:normalize": command_normalize,
+    "command:plot": command_plot,
+    "command:import --test": command_import_test,
+    "command:import": command_import,
+}
+
+
+def run_child(name: str, root: pathlib.Path, result_file: pathlib.Path) -> None:
+    with tempfile.TemporaryDirectory(prefix="archivist-bench-") as scratch:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            run = BENCHMARKS[name](root, pathlib.Path(scratch))
+            io_before = read_proc_io()
+            started = time.perf_counter()
+            files = run()
+            reporting.current().flush()
+            elapsed = time.perf_counter() - started
+            io_after = read_proc_io()
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    syscalls = {key: io_after[key] - io_before[key] if key in io_after else None for key in ("syscr", "syscw")}
+    measurement = Measurement(name, elapsed, files, syscalls["syscr"], syscalls["syscw"], peak_rss_kb)
+    result_file.write_text(json.dumps(asdict(measurement)))
+
+def measure(name: str, root: pathlib.Path, repeat: int) -> Measurement:
+    """Best of `repeat` runs, each in a fresh process."""
+    best = None
+    for _ in range(repeat):
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            subprocess.run([sys.executable, "-m", "benchmarks.run", str(root), "--child", name, result_file.name], check=True)
+            measurement = Measurement(**json.loads(pathlib.Path(result_file.name).read_text()))
+        if best is None or measurement.elapsed < best.elapsed:
+            best = measurement
+    return best
+
+def format_row(m: Measurement, baseline: Measurement | None) -> str:
+    syscalls = "-" if m.read_syscalls is None else f"{m.read_syscalls + m.write_syscalls}"
+    row = f"{m.name:<28} {m.elapsed:>9.3f}s {m.files_per_second:>12.1f} {syscalls:>10} {m.peak_rss_kb / 1024:>9.1f}"
+    if baseline is not None:
+        row += f" {m.elapsed / baseline.elapsed if baseline.elapsed > 0 else 1.0:>8.2f}x"
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", type=pathlib.Path, help="Benchmark data directory - generated if it doesn't contain an archive")
+    parser.add_argument("-n", "--files", type=int, default=2000, help="Number of photos to generate")
+    parser.add_argument("-k", "--only", action="append", default=[], help="Only run benchmarks whose name contains this (repeatable)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per benchmark, the best one counts")
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="Save results as JSON, e.g. as a new baseline")
+    parser.add_argument("-b", "--baseline", type=pathlib.Path, help="Compare against results saved earlier")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline before failing")
+    parser.add_argument("--child", nargs=2, metavar=("NAME", "RESULT_FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        name, result_file = args.child
+        run_child(name, args.root, pathlib.Path(result_file))
+        return
+
+    if not (args.root / "archive").is_dir():
+        print(f"Generating synthetic archive with {args.files} photos in '{args.root}'...")
+        generate_archive.generate(args.root, args.files, years=5, raw_ratio=0.6, orphan_ratio=0.1, file_size=32 * 1024, seed=1)
+
+    baseline = {}
+    if args.baseline is not None:
+        baseline = {m["name"]: Measurement(**m) for m in json.loads(args.baseline.read_text())}
+
+    print(f"{"benchmark":<28} {"elapsed":>10} {"files/s":>12} {"syscalls":>10} {"RSS (MB)":>9}" + (" vs. base" if baseline else ""))
+    results = []
+    regressions = []
+    for name in BENCHMARKS:
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        measurement = measure(name, args.root, args.repeat)
+        results.append(measurement)
+        reference = baseline.get(name)
+        print(format_row(measurement, reference))
+        if reference is not None and measurement.elapsed > reference.elapsed * (1 + args.tolerance):
+            regressions.append(name)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps([asdict(m) for m in results], indent=2))
+    if regressions:
+        print(f"Slower than baseline by more than {args.tolerance:.0%}: {", ".join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
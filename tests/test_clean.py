@@ -0,0 +1,93 @@
+import pathlib, tempfile, unittest
+
+from archivist import reporting
+from archivist.clean_command import clean_recursive, find_file_matches
+
+
+def matched_names(matches) -> tuple[set, set, set]:
+    """Names of the (processed, RAW) pairs, of the processed files without a RAW file, and of the RAW files without a processed one."""
+    both = {(m.processed_file.name, m.raw_file.name) for m in matches if m.is_matched}
+    processed = {m.processed_file.name for m in matches if m.has_processed and not m.has_raw}
+    raw = {m.raw_file.name for m in matches if m.should_remove_raw}
+    return both, processed, raw
+
+
+class FindFileMatchesTest(unittest.TestCase):
+    def match(self, processed: list[str], raw: list[str]) -> tuple[set, set, set]:
+        return matched_names(find_file_matches([pathlib.Path("base", name) for name in processed],
+                                               [pathlib.Path("base", "raw", name) for name in raw]))
+
+    def test_pairs_by_stem(self):
+        self.assertEqual(self.match(["a.jpg", "b.heif"], ["a.raf", "b.nef", "c.raf"]),
+                         ({("a.jpg", "a.raf"), ("b.heif", "b.nef")}, set(), {"c.raf"}))
+
+    def test_suffix_case_ignored(self):
+        self.assertEqual(self.match(["DSCF0001.JPG", "DSCF0002.jpeg"], ["DSCF0001.raf", "DSCF0002.RAF"]),
+                         ({("DSCF0001.JPG", "DSCF0001.raf"), ("DSCF0002.jpeg", "DSCF0002.RAF")}, set(), set()))
+
+    def test_stem_case_matters(self):
+        self.assertEqual(self.match(["dscf0001.jpg"], ["DSCF0001.RAF"]), (set(), {"dscf0001.jpg"}, {"DSCF0001.RAF"}))
+
+    def test_multiple_processed_variants(self):
+        both, processed, raw = self.match(["a.jpg", "a.heic", "a.JPEG"], ["a.RAF"])
+        self.assertEqual(len(both), 1)
+        self.assertEqual(len(processed), 2)
+        self.assertEqual(raw, set())
+        self.assertEqual({name for name, _ in both} | processed, {"a.jpg", "a.heic", "a.JPEG"})
+
+    def test_processed_without_raw(self):
+        self.assertEqual(self.match(["a.jpg"], []), (set(), {"a.jpg"}, set()))
+
+    def test_other_suffixes_of_stem_dont_match(self):
+        self.assertEqual(self.match(["a.edited.jpg", "a-1.jpg"], ["a.raf"]), (set(), {"a.edited.jpg", "a-1.jpg"}, {"a.raf"}))
+
+
+class CleanRecursiveTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self._dir.name)
+        self._reporter = reporting.current()
+        reporting.use(reporting.Reporter("quiet"))
+
+    def tearDown(self):
+        reporting.use(self._reporter)
+        self._dir.cleanup()
+
+    def files(self, folder: str, *names: str):
+        (self.root / folder).mkdir(parents=True, exist_ok=True)
+        for name in names:
+            (self.root / folder / name).touch()
+
+    def names(self, folder: str) -> set[str]:
+        return {file.name for file in (self.root / folder).iterdir() if file.is_file()}
+
+    def test_removes_unmatched_raw_files(self):
+        self.files("2021/06", "DSCF0001.JPG", "DSCF0002.jpg", "DSCF0002.HEIC", "dscf0003.jpg")
+        self.files("2021/06/raw", "DSCF0001.raf", "DSCF0002.RAF", "DSCF0003.RAF", "DSCF0004.raf")
+        clean_recursive(self.root, test_only=False, jobs=2)
+        self.assertEqual(self.names("2021/06/raw"), {"DSCF0001.raf", "DSCF0002.RAF"})
+        self.assertEqual(self.names("2021/06"), {"DSCF0001.JPG", "DSCF0002.jpg", "DSCF0002.HEIC", "dscf0003.jpg"})
+
+    def test_test_only_removes_nothing(self):
+        self.files("2021/06", "a.jpg")
+        self.files("2021/06/raw", "a.raf", "b.raf")
+        clean_recursive(self.root, test_only=True, jobs=2)
+        self.assertEqual(self.names("2021/06/raw"), {"a.raf", "b.raf"})
+
+    def test_folders_cleaned_separately(self):
+        self.files("2021/06", "a.jpg")
+        self.files("2021/06/raw", "a.raf", "b.raf")
+        self.files("2021/07", "b.jpg")
+        self.files("2021/07/raw", "a.raf", "b.raf")
+        clean_recursive(self.root, test_only=False, jobs=2)
+        self.assertEqual(self.names("2021/06/raw"), {"a.raf"})
+        self.assertEqual(self.names("2021/07/raw"), {"b.raf"})
+
+    def test_raw_only_folder_left_alone(self):
+        self.files("2021/06/raw", "a.raf", "b.raf")
+        clean_recursive(self.root, test_only=False, jobs=2)
+        self.assertEqual(self.names("2021/06/raw"), {"a.raf", "b.raf"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,13 @@
+import unittest
+
+from archivist import aggregation, constants
+
+
+class ConstantsTest(unittest.TestCase):
+    def test_plot_choices_match_aggregation(self):
+        self.assertEqual(constants.DIMENSION_NAMES, list(aggregation.DIMENSIONS))
+        self.assertEqual(constants.GROUPING_NAMES, list(aggregation.GROUPINGS))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import datetime, os, pathlib, tempfile, unittest
+
+from archivist.import_command import ImportFile, ImportPlanner
+
+CAPTURE_TIME = datetime.datetime(2021, 6, 5, 14, 30, 0)
+
+
+class ImportPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.archive = pathlib.Path(self._dir.name)
+        self.folder = self.archive / "2021" / "06"
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def existing(self, *names: str):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for name in names:
+            (self.folder / name).touch()
+
+    def plan(self, planner: ImportPlanner, *names: str, capture_time: datetime.datetime = CAPTURE_TIME) -> list[str]:
+        return [planner.plan(ImportFile(pathlib.Path("inbox", name), capture_time)).canonical_name for name in names]
+
+    def test_empty_archive(self):
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.jpg", "b.jpg", "c.jpg"),
+                         ["20210605_14_30_00.jpeg", "20210605_14_30_00-1.jpeg", "20210605_14_30_00-2.jpeg"])
+
+    def test_planned_into_year_month_folder(self):
+        operation = ImportPlanner(self.archive).plan(ImportFile(pathlib.Path("inbox", "a.raf"), CAPTURE_TIME))
+        self.assertEqual(operation.canonical_path, self.folder / "20210605_14_30_00.raf")
+
+    def test_numbering_continues_after_existing_files(self):
+        self.existing("20210605_14_30_00.jpeg", "20210605_14_30_00-1.jpeg")
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.jpg", "b.jpg"), ["20210605_14_30_00-2.jpeg", "20210605_14_30_00-3.jpeg"])
+
+    def test_numbering_continues_after_highest_number(self):
+        # Gaps left by removed files aren't filled, so a name is never given to a different file than before
+        self.existing("20210605_14_30_00.jpeg", "20210605_14_30_00-4.jpeg")
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.jpg"), ["20210605_14_30_00-5.jpeg"])
+
+    def test_numbered_file_without_plain_one(self):
+        self.existing("20210605_14_30_00-2.jpeg")
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.jpg"), ["20210605_14_30_00-3.jpeg"])
+
+    def test_existing_suffixes_normalized(self):
+        self.existing("20210605_14_30_00.JPG", "20210605_14_30_00.heic")
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.jpeg", "b.hif"), ["20210605_14_30_00-1.jpeg", "20210605_14_30_00-1.heif"])
+
+    def test_suffixes_numbered_separately(self):
+        self.existing("20210605_14_30_00.jpeg")
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.raf", "a.jpg"), ["20210605_14_30_00.raf", "20210605_14_30_00-1.jpeg"])
+
+    def test_other_files_ignored(self):
+        self.existing("20210605_14_30_00.jpeg.tmp", "IMG_0001.jpeg", "20210605_14_30_00-x.jpeg")
+        self.assertEqual(self.plan(ImportPlanner(self.archive), "a.jpg"), ["20210605_14_30_00.jpeg"])
+
+    def test_other_capture_times_and_folders(self):
+        self.existing("20210605_14_30_00.jpeg")
+        planner = ImportPlanner(self.archive)
+        self.assertEqual(self.plan(planner, "a.jpg", capture_time=CAPTURE_TIME.replace(second=1)), ["20210605_14_30_01.jpeg"])
+        self.assertEqual(self.plan(planner, "b.jpg", capture_time=CAPTURE_TIME.replace(month=7)), ["20210705_14_30_00.jpeg"])
+
+    def test_refresh_seeds_changed_folders_again(self):
+        self.existing("20210605_14_30_00.jpeg")
+        planner = ImportPlanner(self.archive)
+        self.assertEqual(self.plan(planner, "a.jpg"), ["20210605_14_30_00-1.jpeg"])
+        # Another import took further names meanwhile
+        self.existing("20210605_14_30_00-1.jpeg", "20210605_14_30_00-2.jpeg")
+        os.utime(self.folder, ns=(0, 0))
+        planner.refresh()
+        self.assertEqual(self.plan(planner, "b.jpg"), ["20210605_14_30_00-3.jpeg"])
+
+    def test_refresh_seeds_folders_created_since(self):
+        planner = ImportPlanner(self.archive)
+        self.assertEqual(self.plan(planner, "a.jpg"), ["20210605_14_30_00.jpeg"])
+        self.existing("20210605_14_30_00.jpeg", "20210605_14_30_00-1.jpeg")
+        planner.refresh()
+        self.assertEqual(self.plan(planner, "b.jpg"), ["20210605_14_30_00-2.jpeg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
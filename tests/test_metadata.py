@@ -0,0 +1,125 @@
+import pathlib, struct, tempfile, unittest
+
+from archivist import metadata, utils
+
+
+def tiff(entries: list[tuple[int, int, int, bytes]], exif_entries: list[tuple[int, int, int, bytes]] = (), endian: str = "<") -> bytes:
+    """
+    Build a minimal TIFF structure: IFD0 with the given (tag, type, count, value) entries, and an Exif IFD
+    with exif_entries. Values longer than 4 bytes are stored after the IFDs.
+    """
+    def ifd_size(n: int) -> int:
+        return 2 + n * 12 + 4
+
+    ifd0 = list(entries) + ([(metadata.EXIF_IFD_POINTER, 4, 1, None)] if exif_entries else [])
+    ifd0_offset = 8
+    exif_offset = ifd0_offset + ifd_size(len(ifd0))
+    data_offset = exif_offset + (ifd_size(len(exif_entries)) if exif_entries else 0)
+    data = b""
+
+    def pack_ifd(ifd) -> bytes:
+        nonlocal data
+        out = struct.pack(endian + "H", len(ifd))
+        for tag, field_type, count, value in ifd:
+            if value is None:
+                raw = struct.pack(endian + "I", exif_offset)
+            elif len(value) <= 4:
+                raw = value.ljust(4, b"\x00")
+            else:
+                raw = struct.pack(endian + "I", data_offset + len(data))
+                data += value
+            out += struct.pack(endian + "HHI", tag, field_type, count) + raw
+        return out + struct.pack(endian + "I", 0)
+
+    body = pack_ifd(ifd0) + (pack_ifd(exif_entries) if exif_entries else b"")
+    order = b"II" if endian == "<" else b"MM"
+    return order + struct.pack(endian + "HI", 42, ifd0_offset) + body + data
+
+def ascii(tag: str, text: str) -> tuple[int, int, int, bytes]:
+    value = text.encode() + b"\x00"
+    return (metadata.TAG_IDS[tag], 2, len(value), value)
+
+def rational(tag: str, n: int, d: int, endian: str = "<") -> tuple[int, int, int, bytes]:
+    return (metadata.TAG_IDS[tag], 5, 1, struct.pack(endian + "II", n, d))
+
+def short(tag: str, value: int, endian: str = "<") -> tuple[int, int, int, bytes]:
+    return (metadata.TAG_IDS[tag], 3, 1, struct.pack(endian + "H", value))
+
+def jpeg(tiff_data: bytes) -> bytes:
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+    app1 = b"\xff\xe1" + struct.pack(">H", 2 + 6 + len(tiff_data)) + b"Exif\x00\x00" + tiff_data
+    return b"\xff\xd8" + app0 + app1 + b"\xff\xda" + b"\x00" * 16 + b"\xff\xd9"
+
+def raf(jpeg_data: bytes) -> bytes:
+    header = metadata.RAF_MAGIC.ljust(84, b"\x00")
+    offset = len(header) + 8
+    return header + struct.pack(">II", offset, len(jpeg_data)) + jpeg_data
+
+
+SAMPLE = tiff([ascii("make", "FUJIFILM"), ascii("model", "X-T4")],
+              [ascii("datetime_original", "2021:06:05 14:30:00"), rational("f_number", 28, 10), short("focal_length_in_35mm_film", 35)])
+SAMPLE_TAGS = {"make": "FUJIFILM", "model": "X-T4", "datetime_original": "2021:06:05 14:30:00", "f_number": 2.8, "focal_length_in_35mm_film": 35}
+
+
+class ReadTagsTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self._dir.name)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def write(self, name: str, data: bytes) -> pathlib.Path:
+        file = self.dir / name
+        file.write_bytes(data)
+        return file
+
+    def read(self, name: str, data: bytes, tags=tuple(SAMPLE_TAGS)) -> dict | None:
+        return metadata.read_tags(self.write(name, data), tags)
+
+    def test_jpeg(self):
+        self.assertEqual(self.read("a.jpg", jpeg(SAMPLE)), SAMPLE_TAGS)
+
+    def test_tiff(self):
+        self.assertEqual(self.read("a.tif", SAMPLE), SAMPLE_TAGS)
+
+    def test_tiff_big_endian(self):
+        data = tiff([ascii("make", "NIKON")], [rational("f_number", 4, 1, ">"), short("focal_length_in_35mm_film", 50, ">")], endian=">")
+        self.assertEqual(self.read("a.nef", data, ("make", "f_number", "focal_length_in_35mm_film")),
+                         {"make": "NIKON", "f_number": 4.0, "focal_length_in_35mm_film": 50})
+
+    def test_raf(self):
+        self.assertEqual(self.read("a.raf", raf(jpeg(SAMPLE))), SAMPLE_TAGS)
+
+    def test_missing_tags(self):
+        self.assertEqual(self.read("a.tif", SAMPLE, ("make", "lens_model")), {"make": "FUJIFILM", "lens_model": None})
+
+    def test_jpeg_without_exif(self):
+        self.assertIsNone(self.read("a.jpg", b"\xff\xd8\xff\xda" + b"\x00" * 16))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(metadata.UnsupportedFormat):
+            self.read("a.png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 16)
+
+    def test_truncated_headers(self):
+        for name, data in [("a.jpg", jpeg(SAMPLE)), ("a.tif", SAMPLE), ("a.raf", raf(jpeg(SAMPLE)))]:
+            # Cut off anywhere after the part telling the format apart, and before the last tag value
+            for size in range(16, len(data) - 24, 7):
+                with self.subTest(name=name, size=size), self.assertRaises((ValueError, struct.error)):
+                    self.read(name, data[:size])
+
+    def test_invalid_tiff_header(self):
+        with self.assertRaises(ValueError):
+            self.read("a.tif", b"II" + struct.pack("<HI", 7, 8) + b"\x00" * 8)
+
+    def test_zero_rationals(self):
+        data = tiff([], [rational("f_number", 0, 0), rational("exposure_time", 28, 0)])
+        self.assertEqual(self.read("a.tif", data, ("f_number", "exposure_time")), {"f_number": 0, "exposure_time": None})
+
+    def test_bad_rational_doesnt_fail_reading(self):
+        file = self.write("a.jpg", jpeg(tiff([ascii("make", "FUJIFILM")], [rational("f_number", 28, 0)])))
+        self.assertEqual(utils.read_exif_tags_uncached(file, ("make", "f_number")), {"make": "FUJIFILM", "f_number": None})
+
+
+if __name__ == "__main__":
+    unittest.main()
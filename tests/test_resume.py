@@ -0,0 +1,110 @@
+import pathlib, tempfile, unittest
+
+from archivist import reporting
+from archivist.import_command import resume_import, verify_partial_operation
+from archivist.journal import ImportJournal
+
+DATA = b"photo data" * 100
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self._dir.name)
+        self.inbox = self.dir / "inbox"
+        self.archive = self.dir / "archive"
+        (self.archive / "2021" / "06").mkdir(parents=True)
+        self.inbox.mkdir()
+        self._reporter = reporting.current()
+        reporting.use(reporting.Reporter("quiet"))
+
+    def tearDown(self):
+        reporting.use(self._reporter)
+        self._dir.cleanup()
+
+    def operation(self, name: str, source: bytes | None, target: bytes | None) -> tuple[pathlib.Path, pathlib.Path]:
+        original_path = self.inbox / f"{name}.jpg"
+        canonical_path = self.archive / "2021" / "06" / f"20210605_14_30_0{name}.jpeg"
+        if source is not None:
+            original_path.write_bytes(source)
+        if target is not None:
+            canonical_path.write_bytes(target)
+        return original_path, canonical_path
+
+    def verify(self, source: bytes | None, target: bytes | None, move_files: bool) -> tuple[bool | None, pathlib.Path, pathlib.Path]:
+        original_path, canonical_path = self.operation("0", source, target)
+        return verify_partial_operation(original_path, canonical_path, len(DATA), move_files), original_path, canonical_path
+
+    def test_target_missing_source_present(self):
+        for move_files in (False, True):
+            with self.subTest(move_files=move_files):
+                state, original_path, _ = self.verify(DATA, None, move_files)
+                self.assertIs(state, False)
+                self.assertTrue(original_path.exists())
+
+    def test_target_and_source_missing(self):
+        self.assertIsNone(self.verify(None, None, True)[0])
+
+    def test_target_exists_source_absent(self):
+        # Moved before the interruption, but not recorded as done
+        state, _, canonical_path = self.verify(None, DATA, True)
+        self.assertIs(state, True)
+        self.assertEqual(canonical_path.read_bytes(), DATA)
+
+    def test_target_exists_source_present_copying(self):
+        state, original_path, _ = self.verify(DATA, DATA, False)
+        self.assertIs(state, True)
+        self.assertTrue(original_path.exists())
+
+    def test_target_exists_source_present_moving(self):
+        # Copied across filesystems, interrupted before the original was removed
+        state, original_path, _ = self.verify(DATA, DATA, True)
+        self.assertIs(state, True)
+        self.assertFalse(original_path.exists())
+
+    def test_partial_copy_source_present(self):
+        for move_files in (False, True):
+            with self.subTest(move_files=move_files):
+                state, original_path, _ = self.verify(DATA, DATA[:100], move_files)
+                self.assertIs(state, False)
+                self.assertTrue(original_path.exists())
+
+    def test_same_size_different_contents(self):
+        state, original_path, _ = self.verify(DATA, bytes(len(DATA)), True)
+        self.assertIs(state, False)
+        self.assertTrue(original_path.exists())
+
+    def test_partial_copy_source_absent(self):
+        self.assertIsNone(self.verify(None, DATA[:100], True)[0])
+
+    def test_resume_import(self):
+        operations = [self.operation("0", DATA, None),       # not started
+                      self.operation("1", DATA, DATA[:100]),  # partial copy
+                      self.operation("2", None, DATA),       # moved, but not recorded as done
+                      self.operation("3", None, DATA),       # recorded as done
+                      self.operation("4", None, None)]       # lost
+        with ImportJournal(self.archive) as journal:
+            journal.begin(True)
+            journal.planned_all((original_path, canonical_path, len(DATA)) for original_path, canonical_path in operations)
+            journal.completed(operations[3][1])
+
+        resume_import(self.archive, test_only=False, copy_jobs=2)
+        for original_path, canonical_path in operations[:4]:
+            self.assertFalse(original_path.exists())
+            self.assertEqual(canonical_path.read_bytes(), DATA)
+        self.assertFalse(operations[4][1].exists())
+        self.assertEqual(ImportJournal(self.archive).unfinished_runs(), [])
+
+    def test_resume_import_test_only(self):
+        original_path, canonical_path = self.operation("0", DATA, DATA[:100])
+        with ImportJournal(self.archive) as journal:
+            journal.begin(False)
+            journal.planned(original_path, canonical_path, len(DATA))
+
+        resume_import(self.archive, test_only=True, copy_jobs=2)
+        self.assertEqual(canonical_path.read_bytes(), DATA[:100])
+        self.assertEqual(len(ImportJournal(self.archive).unfinished_runs()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()